@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+##
+##  Copyright 2016 SRI International
+##  See COPYING file distributed along with the package for the copyright and license terms.
+##
+"""
+============================
+REDCap Form Locker Benchmark
+============================
+
+Compares the per-subject locked forms report (report_locked_forms) with the
+batched report (report_locked_forms_batch) on a synthetic SQLite stand-in for
+the REDCap MySQL database, and checks that both produce the same reports.
+
+Example Usage:
+
+python benchmark_form_locker.py --subjects 800 --forms 60
+"""
+
+import os
+import sys
+import time
+import random
+import datetime
+import tempfile
+
+import pandas as pd
+
+from sqlalchemy import create_engine
+
+import redcap_form_locker as rclocker
+
+project_name = 'ncanda_subject_visit_log'
+arm_name = 'Standard Protocol'
+event_descrips = ['Baseline visit', '1y visit', '2y visit', '3y visit']
+
+
+def create_database(engine, n_subjects, n_forms, n_other_projects=5):
+    """
+    Fill a database with synthetic REDCap project, arm, event, and locking
+    tables. Other projects get locking data as well, so that the queries have
+    to filter.
+
+    :param engine: `sqlalchemy.Engine`
+    :param n_subjects: int
+    :param n_forms: int
+    :param n_other_projects: int
+    :return: tuple (list of (site_id, xnat_id), list of form names)
+    """
+    random.seed(0)
+    subjects = [('X-%05d-M-%d' % (i, i % 10), 'NCANDA_S%05d' % i)
+                for i in range(n_subjects)]
+    forms = ['form_%d' % i for i in range(n_forms)]
+
+    projects = []
+    arms = []
+    events = []
+    locks = []
+    for project_id in range(1, n_other_projects + 2):
+        if project_id == 1:
+            projects.append(dict(project_id=project_id,
+                                 project_name=project_name))
+        else:
+            projects.append(dict(project_id=project_id,
+                                 project_name='other_%d' % project_id))
+        arm_id = project_id
+        arms.append(dict(arm_id=arm_id, project_id=project_id,
+                         arm_name=arm_name))
+        for (idx, descrip) in enumerate(event_descrips):
+            event_id = project_id * 100 + idx
+            events.append(dict(event_id=event_id, arm_id=arm_id,
+                               descrip=descrip))
+            for (site_id, xnat_id) in subjects:
+                for form_name in random.sample(forms, n_forms / 2):
+                    locks.append(dict(project_id=project_id, record=site_id,
+                                      event_id=event_id, form_name=form_name,
+                                      username='benchmark',
+                                      timestamp=datetime.datetime(2016, 1, 1)))
+
+    pd.DataFrame(projects).to_sql('redcap_projects', engine, index=False)
+    pd.DataFrame(arms).to_sql('redcap_events_arms', engine, index=False)
+    pd.DataFrame(events).to_sql('redcap_events_metadata', engine, index=False)
+    locking_data = pd.DataFrame(locks)
+    locking_data.insert(0, 'ld_id', range(1, len(locking_data) + 1))
+    locking_data.to_sql('redcap_locking_data', engine, index=False)
+
+    return subjects, forms
+
+
+def main(args=None):
+    (fd, db_fname) = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        engine = create_engine('sqlite:///{0}'.format(db_fname))
+        subjects, forms = create_database(engine, args.subjects, args.forms)
+        if args.verbose:
+            print "Created SQLite stand-in database: {0}".format(db_fname)
+
+        start = time.time()
+        per_subject = dict()
+        for event_descrip in event_descrips:
+            for (site_id, xnat_id) in subjects:
+                per_subject[(site_id, event_descrip)] = \
+                    rclocker.report_locked_forms(site_id, xnat_id, forms,
+                                                 project_name, arm_name,
+                                                 event_descrip, engine)
+        per_subject_time = time.time() - start
+
+        start = time.time()
+        batched = dict()
+        id_tables = rclocker.load_id_tables(engine)
+        for event_descrip in event_descrips:
+            reports = rclocker.report_locked_forms_batch(subjects, forms,
+                                                         project_name,
+                                                         arm_name,
+                                                         event_descrip, engine,
+                                                         id_tables=id_tables)
+            for (site_id, report) in reports.iteritems():
+                batched[(site_id, event_descrip)] = report
+        batched_time = time.time() - start
+
+        mismatches = [key for key in per_subject.keys()
+                      if per_subject[key].to_csv(index=False) !=
+                      batched[key].to_csv(index=False)]
+
+        n_reports = len(per_subject)
+        print "{0} reports ({1} subjects, {2} forms)".format(
+            n_reports, args.subjects, args.forms)
+        print "per-subject: {0:.2f}s ({1:.1f} reports/s)".format(
+            per_subject_time, n_reports / per_subject_time)
+        print "batched:     {0:.2f}s ({1:.1f} reports/s)".format(
+            batched_time, n_reports / batched_time)
+        if mismatches:
+            print "ERROR: {0} reports differ, e.g., {1}".format(
+                len(mismatches), mismatches[0])
+            return 1
+    finally:
+        os.remove(db_fname)
+
+if __name__ == "__main__":
+    import argparse
+
+    formatter = argparse.RawDescriptionHelpFormatter
+    default = 'default: %(default)s'
+    parser = argparse.ArgumentParser(prog="benchmark_form_locker.py",
+                                     description=__doc__,
+                                     formatter_class=formatter)
+    parser.add_argument("-s", "--subjects", dest="subjects", type=int,
+                        default=200,
+                        help="Number of subjects. {0}".format(default))
+    parser.add_argument("-f", "--forms", dest="forms", type=int, default=50,
+                        help="Number of forms per event. {0}".format(default))
+    parser.add_argument("-v", "--verbose", dest="verbose",
+                        help="Turn on verbose", action='store_true')
+    args = parser.parse_args()
+    sys.exit(main(args=args))
@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+
+##
+##  Copyright 2016 SRI International
+##  See COPYING file distributed along with the package for the copyright and license terms.
+##
+"""
+=================
+Scoring Benchmark
+=================
+
+Times the scoring function (compute_scores) of every instrument registered in
+the scoring package on synthetic input data, and reports records per second
+and peak memory use for each instrument and number of records.
+
+Synthetic records have all input fields of an instrument, with values drawn
+according to the field definitions in the REDCap data dictionary (choices of
+dropdown, radio, and checkbox fields, validation type and range of text
+fields). Each run is done in a separate process, so that peak memory is
+measured per run.
+
+Instruments that are scored in R are run against a fake Rscript, which speaks
+the R worker protocol and returns made-up scores with the names each
+instrument expects, so the benchmark runs without R installed. Their times
+measure the Python side of the R worker pool only.
+
+If scoring fails for any instrument, the benchmark stops with the error and
+a non-zero exit status. Results can be saved, and compared against saved
+results to catch performance regressions (also reported with a non-zero exit
+status).
+
+Example Usage:
+
+python benchmark_scoring.py --sizes 100,1000 --instruments brief,bmi
+python benchmark_scoring.py --save baseline.json
+python benchmark_scoring.py --compare baseline.json
+"""
+
+import os
+import re
+import sys
+import csv
+import json
+import stat
+import time
+import shutil
+import StringIO
+import resource
+import tempfile
+import traceback
+import multiprocessing
+
+import numpy
+import pandas
+
+import scoring
+import redcap_field_patterns
+
+# The scoring package puts its directory on the module path
+import Rworker
+import Rwrapper
+
+default_datadict = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'datadict',
+                                'NCANDADataEntry_DataDictionary.csv')
+
+events = ['baseline_visit_arm_1', '1y_visit_arm_1', '2y_visit_arm_1']
+
+# Fraction of answers left empty - rare, so that most records with many
+# fields are still complete
+blank_fraction = 0.002
+
+# Stand-in for Rscript running "Rworker.R": answers "ping", "score", and
+# "quit" requests, and returns fixed scores in the format each R script writes
+fake_rscript = '''#!{python}
+import sys
+import csv
+import json
+import zlib
+import StringIO
+
+outputs = json.load(open({outputs_file!r}))
+
+def make_scores(Rscript, payload):
+    (names, scores_key) = outputs[Rscript]
+    seed = zlib.crc32(payload) & 0xffff
+    values = [(seed + idx) % 10 for idx in range(len(names))]
+
+    scores_csv = StringIO.StringIO()
+    writer = csv.writer(scores_csv, quoting=csv.QUOTE_NONNUMERIC)
+    if scores_key:
+        writer.writerow(['', scores_key])
+        for (name, value) in zip(names, values):
+            writer.writerow([name, value])
+    else:
+        writer.writerow(names)
+        writer.writerow(values)
+    return scores_csv.getvalue()
+
+def respond(status, payload):
+    sys.stdout.write('%s %d\\n' % (status, len(payload)))
+    sys.stdout.write(payload)
+    sys.stdout.flush()
+
+while True:
+    header = sys.stdin.readline()
+    if not header:
+        break
+    (command, argument, nbytes) = header.rsplit(' ', 2)
+    payload = sys.stdin.read(int(nbytes))
+    if command == 'quit':
+        break
+    elif command == 'ping':
+        respond('pong', '')
+    elif command == 'score':
+        if argument in outputs:
+            respond('ok', make_scores(argument, payload))
+        else:
+            respond('error', 'no fake scores for ' + argument)
+    else:
+        respond('error', 'unknown command ' + command)
+'''
+
+# How R-based instruments call the R wrapper - the script and the key of the
+# scores in its output
+runscript_call = re.compile(r"runscript_batch\(\s*data\s*,"
+                            r"\s*Rscript\s*=\s*'([^']+)'"
+                            r"(?:\s*,\s*scores_key\s*=\s*'([^']+)')?")
+
+
+def get_R_outputs(instruments):
+    """
+    Find the R script and score names of all R-based instruments
+
+    :param instruments: list of str
+    :return: dict of R script path -> (list of score names, scores key or None)
+    """
+    outputs = dict()
+    for instrument in instruments:
+        module = scoring.load_instrument(instrument)
+        R2rc = getattr(module, 'R2rc', None)
+        if not R2rc:
+            continue
+        source_file = re.sub(r'\.pyc$', '.py', module.__file__)
+        with open(source_file, 'r') as fi:
+            for (Rscript, scores_key) in runscript_call.findall(fi.read()):
+                outputs[os.path.join(scoring.module_dir, Rscript)] = \
+                    (sorted(R2rc.keys()), scores_key or None)
+    return outputs
+
+
+def install_fake_rscript(tmpdir, instruments):
+    """
+    Write the fake Rscript and make the R worker pool use it
+
+    :param tmpdir: str
+    :param instruments: list of str
+    :return: None
+    """
+    outputs_file = os.path.join(tmpdir, 'outputs.json')
+    with open(outputs_file, 'w') as fi:
+        json.dump(get_R_outputs(instruments), fi)
+
+    rscript = os.path.join(tmpdir, 'Rscript')
+    with open(rscript, 'w') as fi:
+        fi.write(fake_rscript.format(python=sys.executable,
+                                     outputs_file=outputs_file))
+    os.chmod(rscript, os.stat(rscript).st_mode | stat.S_IXUSR)
+    Rworker.Rscript_binary = rscript
+
+
+def load_datadict(fname):
+    """
+    Read a REDCap data dictionary
+
+    :param fname: str
+    :return: dict of field name -> dict of field attributes
+    """
+    with open(fname, 'rb') as fi:
+        return dict([(row['Variable / Field Name'], row)
+                     for row in csv.DictReader(fi)])
+
+
+def get_choices(field):
+    choices = field['Choices, Calculations, OR Slider Labels']
+    return [choice.split(',')[0].strip() for choice in choices.split('|')
+            if choice.strip()]
+
+
+def get_input_columns(instrument, resolver, datadict):
+    """
+    Get the columns of an instrument's input records, as exported from REDCap
+    (checkbox fields have one column per choice)
+
+    :param instrument: str
+    :param resolver: `redcap_field_patterns.FieldPatternResolver`
+    :param datadict: dict
+    :return: list of str
+    """
+    fields = []
+    for patterns in scoring.fields_list[instrument].values():
+        for pattern in patterns:
+            matches = resolver.match(pattern)
+            if not matches and redcap_field_patterns.is_literal(pattern):
+                matches = [pattern]
+            fields += [field for field in matches if field not in fields]
+
+    columns = []
+    for field in fields:
+        if field in datadict and datadict[field]['Field Type'] == 'checkbox':
+            columns += ['%s___%s' % (field, code)
+                        for code in get_choices(datadict[field])]
+        elif field in datadict and datadict[field]['Field Type'] == 'file':
+            continue
+        else:
+            columns.append(field)
+    return columns
+
+
+def get_float(value, default):
+    try:
+        return float(value)
+    except ValueError:
+        return default
+
+
+def make_dates(rng, n, first='2012-01-01', last='2017-12-31'):
+    first_day = numpy.datetime64(first, 'D').astype(int)
+    last_day = numpy.datetime64(last, 'D').astype(int)
+    days = rng.randint(first_day, last_day + 1, size=n)
+    return [str(day) for day in days.astype('datetime64[D]')]
+
+
+def make_values(rng, column, field, n):
+    """
+    Draw n synthetic values for one input column
+
+    :param rng: `numpy.random.RandomState`
+    :param column: str
+    :param field: dict of field attributes from the data dictionary, or None
+    :param n: int
+    :return: list
+    """
+    if column.endswith('_complete'):
+        return list(rng.choice([0, 1, 2], size=n, p=[0.05, 0.1, 0.85]))
+    if column.endswith('_missing'):
+        return list(rng.choice([0, 1], size=n, p=[0.9, 0.1]))
+    if '___' in column:
+        return list(rng.randint(0, 2, size=n))
+
+    field_type = field['Field Type'] if field else 'text'
+    validation = field['Text Validation Type OR Show Slider Number'] \
+        if field else ''
+    if field_type in ['dropdown', 'radio']:
+        values = list(rng.choice(get_choices(field), size=n))
+    elif field_type in ['yesno', 'truefalse']:
+        values = list(rng.randint(0, 2, size=n))
+    elif field_type == 'notes':
+        return [''] * n
+    elif validation == 'date_ymd' or 'date' in column:
+        values = make_dates(rng, n)
+    elif validation == 'datetime_mdy':
+        values = ['%s %02d:%02d' % (date, hour, minute) for (date, hour, minute)
+                  in zip(make_dates(rng, n), rng.randint(0, 24, size=n),
+                         rng.randint(0, 60, size=n))]
+    elif validation == 'time':
+        values = ['%02d:%02d' % (hour, minute) for (hour, minute)
+                  in zip(rng.randint(0, 24, size=n),
+                         rng.randint(0, 60, size=n))]
+    elif validation in ['number', 'integer'] or field_type == 'calc':
+        low = get_float(field['Text Validation Min'], 0)
+        high = get_float(field['Text Validation Max'], 100)
+        values = rng.uniform(low, high, size=n)
+        if validation == 'integer':
+            values = numpy.round(values).astype(int)
+        values = list(values)
+    else:
+        values = list(rng.randint(0, 21, size=n))
+
+    blanks = rng.uniform(size=n) < blank_fraction
+    return ['' if blank else value for (value, blank) in zip(values, blanks)]
+
+
+def make_records(instrument, n_records, resolver, datadict, seed):
+    """
+    Make synthetic input records for an instrument, and demographics for their
+    subjects, parsed the same way as the input data exported from REDCap
+
+    :param instrument: str
+    :param n_records: int
+    :param resolver: `redcap_field_patterns.FieldPatternResolver`
+    :param datadict: dict
+    :param seed: int
+    :return: tuple (`pandas.DataFrame` records, `pandas.DataFrame` demographics)
+    """
+    rng = numpy.random.RandomState(seed)
+    columns = get_input_columns(instrument, resolver, datadict)
+
+    n_subjects = (n_records + len(events) - 1) / len(events)
+    subjects = ['X-%05d-%s-%d' % (idx, 'FM'[idx % 2], idx % 10)
+                for idx in range(n_subjects)]
+    records = pandas.DataFrame(
+        dict([(column, make_values(rng, column, datadict.get(column),
+                                   n_records))
+              for column in columns]), columns=columns)
+    records.insert(0, 'study_id', [subjects[idx / len(events)]
+                                   for idx in range(n_records)])
+    records.insert(1, 'redcap_event_name', [events[idx % len(events)]
+                                            for idx in range(n_records)])
+
+    demographics = pandas.DataFrame(
+        dict(study_id=subjects,
+             dob=make_dates(rng, n_subjects, '1994-01-01', '1999-12-31'),
+             sex=rng.choice(get_choices(datadict['sex']) if 'sex' in datadict
+                            else ['0', '1'], size=n_subjects)),
+        columns=['study_id', 'dob', 'sex'])
+
+    records_csv = StringIO.StringIO()
+    records.to_csv(records_csv, index=False)
+    records_csv.seek(0)
+    demographics_csv = StringIO.StringIO()
+    demographics.to_csv(demographics_csv, index=False)
+    demographics_csv.seek(0)
+    return (pandas.read_csv(records_csv, index_col=[0, 1]),
+            pandas.read_csv(demographics_csv, index_col=0).dropna())
+
+
+def get_peak_memory_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_one(instrument, n_records, resolver, datadict, seed, results):
+    """
+    Score synthetic records for one instrument; run in a child process
+
+    :return: None (the result is put on the "results" queue)
+    """
+    result = dict(instrument=instrument, records=n_records)
+    try:
+        (records, demographics) = make_records(instrument, n_records, resolver,
+                                               datadict, seed)
+        memory_before = get_peak_memory_mb()
+        start = time.time()
+        scores = scoring.functions[instrument](records, demographics)
+        result['seconds'] = time.time() - start
+        result['scored'] = len(scores)
+        result['peak_mb'] = get_peak_memory_mb()
+        result['delta_mb'] = result['peak_mb'] - memory_before
+    except:
+        result['error'] = traceback.format_exc()
+    finally:
+        if Rwrapper.worker_pool:
+            Rwrapper.worker_pool.close()
+    results.put(result)
+
+
+def run_benchmark(instrument, n_records, resolver, datadict, seed):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_one,
+                                      args=(instrument, n_records, resolver,
+                                            datadict, seed, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Find runs that are slower than in a baseline by more than a factor
+
+    :param results: list of dict
+    :param baseline: list of dict
+    :param tolerance: float
+    :return: list of str (descriptions of regressions)
+    """
+    baseline_rates = dict([((run['instrument'], run['records']),
+                            run['records_per_second'])
+                           for run in baseline if 'records_per_second' in run])
+    regressions = []
+    for run in results:
+        key = (run['instrument'], run['records'])
+        if key in baseline_rates and 'records_per_second' in run and \
+                run['records_per_second'] * tolerance < baseline_rates[key]:
+            regressions.append("{0} with {1} records: {2:.1f} records/s, "
+                               "baseline {3:.1f} records/s".format(
+                                   key[0], key[1], run['records_per_second'],
+                                   baseline_rates[key]))
+    return regressions
+
+
+def main(args=None):
+    instruments = sorted(scoring.instrument_list)
+    if args.instruments:
+        instruments = [instrument for instrument in args.instruments.split(',')
+                       if instrument in instruments]
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    datadict = load_datadict(args.datadict)
+    resolver = redcap_field_patterns.FieldPatternResolver(datadict.keys())
+
+    tmpdir = tempfile.mkdtemp()
+    Rwrapper.worker_pool_size = args.r_workers
+    install_fake_rscript(tmpdir, instruments)
+
+    results = []
+    try:
+        print "{0:<12}{1:>10}{2:>10}{3:>10}{4:>14}{5:>12}{6:>10}".format(
+            'instrument', 'records', 'scored', 'seconds', 'records/s',
+            'peak MB', '+MB')
+        for instrument in instruments:
+            for n_records in sizes:
+                result = run_benchmark(instrument, n_records, resolver,
+                                       datadict, args.seed)
+                if 'error' in result:
+                    print "ERROR: scoring {0} records of {1} failed".format(
+                        n_records, instrument)
+                    print result['error']
+                    return 1
+
+                result['records_per_second'] = \
+                    n_records / max(result['seconds'], 1e-6)
+                results.append(result)
+                print "{0:<12}{1:>10}{2:>10}{3:>10.3f}{4:>14.1f}{5:>12.1f}" \
+                      "{6:>10.1f}".format(instrument, n_records,
+                                          result['scored'], result['seconds'],
+                                          result['records_per_second'],
+                                          result['peak_mb'], result['delta_mb'])
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if args.save:
+        with open(args.save, 'w') as fi:
+            json.dump(results, fi, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'r') as fi:
+            regressions = compare_results(results, json.load(fi),
+                                          args.tolerance)
+        for regression in regressions:
+            print "REGRESSION:", regression
+        if regressions:
+            return 1
+
+if __name__ == "__main__":
+    import argparse
+
+    formatter = argparse.RawDescriptionHelpFormatter
+    default = 'default: %(default)s'
+    parser = argparse.ArgumentParser(prog="benchmark_scoring.py",
+                                     description=__doc__,
+                                     formatter_class=formatter)
+    parser.add_argument("-i", "--instruments", dest="instruments",
+                        help="Comma-separated instruments to benchmark "
+                             "(default: all)")
+    parser.add_argument("--sizes", dest="sizes", default="100,1000,10000",
+                        help="Comma-separated numbers of records. "
+                             "{0}".format(default))
+    parser.add_argument("--datadict", dest="datadict",
+                        default=default_datadict,
+                        help="REDCap data dictionary of the summary project. "
+                             "{0}".format(default))
+    parser.add_argument("--r-workers", dest="r_workers", type=int,
+                        default=Rworker.default_pool_size,
+                        help="Number of fake R processes. {0}".format(default))
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=0,
+                        help="Random seed. {0}".format(default))
+    parser.add_argument("--save", dest="save",
+                        help="Save results to this JSON file")
+    parser.add_argument("--compare", dest="compare",
+                        help="Compare results to those saved in this JSON file")
+    parser.add_argument("--tolerance", dest="tolerance", type=float,
+                        default=1.5,
+                        help="Report a regression if an instrument is slower "
+                             "than in the compared results by more than this "
+                             "factor. {0}".format(default))
+    args = parser.parse_args()
+    sys.exit(main(args=args))
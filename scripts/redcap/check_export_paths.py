@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+##
+##  Copyright 2016 SRI International
+##  See COPYING file distributed along with the package for the copyright and license terms.
+##
+"""
+==================
+Export Path Checks
+==================
+
+Exports the same synthetic visits through the single-visit path of
+export_redcap_to_pipeline.export (one REDCap request per visit) and through
+the bulk path of export_measures (records of all visits retrieved by
+prefetch_records, and output tables of all visits made by one
+make_export_frames call), and checks that both write identical CSV files.
+
+The REDCap project is simulated: records are made up for the fields of all
+exports in the "exports" directory, and requests are answered with CSV, which
+is read into data frames the way PyCap does. Fields are made coded (with
+labels), numeric, or time fields at random, and values are missing at
+random, so that the type inference of the two paths is put to the test.
+
+Example Usage:
+
+python check_export_paths.py --subjects 50
+"""
+
+import os
+import re
+import sys
+import random
+import shutil
+import filecmp
+import tempfile
+import StringIO
+
+import pandas
+
+import export_redcap_to_pipeline as rcpipeline
+
+# Events of the synthetic visits
+events = ['baseline_visit_arm_1', '1y_visit_arm_1']
+
+# Values drawn for the different kinds of fields (only fields that are not
+# potentially confidential, i.e., coded, numeric, or time fields, are
+# exported)
+choices = '0, No | 1, Yes | 2, Unknown'
+field_values = dict(radio=['', '0', '1', '2'],
+                    checkbox=['0', '1'],
+                    integer=['', '0', '3', '12'],
+                    number=['', '3', '4.5', '12.25'],
+                    time=['', '09:15', '13:40'],
+                    age=['', '15.2345', '16.9', '17'])
+
+
+class SyntheticProject(object):
+    """
+    Simulated REDCap project that answers record exports from a table of
+    string values
+    """
+    def __init__(self, records):
+        self.def_field = 'study_id'
+        self.records = records
+
+    def export_records(self, records=None, fields=None, events=None,
+                       event_name='label', format='df', df_kwargs=None):
+        selected = self.records
+        if records:
+            selected = selected[selected['study_id'].isin(records)]
+        if events:
+            selected = selected[selected['redcap_event_name'].isin(events)]
+        columns = ['study_id', 'redcap_event_name'] + [
+            column for column in self.records.columns[2:]
+            if re.sub('___.*', '', column) in fields]
+
+        buffer = StringIO.StringIO(selected[columns].to_csv(index=False))
+        if not df_kwargs:
+            df_kwargs = dict(index_col=[self.def_field, 'redcap_event_name'])
+        return pandas.read_csv(buffer, **df_kwargs)
+
+
+def make_project(n_subjects):
+    """
+    Make the metadata and records of a simulated project with the fields of
+    all exports
+
+    :param n_subjects: int
+    :return: tuple (list of metadata dicts, `SyntheticProject`)
+    """
+    fields = []
+    for export_name in sorted(rcpipeline.export_forms.keys()):
+        for field in rcpipeline.export_forms[export_name]:
+            if field not in fields:
+                fields.append(field)
+
+    metadata = []
+    field_kinds = dict()
+    for field in fields:
+        base_field = re.sub('___.*', '', field)
+        if '___' in field:
+            kind = 'checkbox'
+        elif field.endswith('_complete'):
+            kind = 'radio'
+        elif field.endswith('_age'):
+            kind = 'age'
+        else:
+            kind = random.choice(['radio', 'integer', 'number', 'time'])
+        field_kinds[field] = kind
+
+        if base_field in [field_info['field_name'] for field_info in metadata]:
+            continue
+        metadata.append(dict(
+            field_name=base_field,
+            field_type=kind if kind in ['radio', 'checkbox'] else 'text',
+            text_validation_type_or_show_slider_number=
+                'number' if kind == 'age' else kind,
+            field_label=base_field, text_validation_min='',
+            text_validation_max='',
+            select_choices_or_calculations=choices if kind == 'radio' else ''))
+
+    rows = []
+    for idx in range(n_subjects):
+        for event in events:
+            row = ['X-%05d-M-%d' % (idx, idx % 10), event]
+            for field in fields:
+                row.append(random.choice(field_values[field_kinds[field]]))
+            rows.append(row)
+
+    records = pandas.DataFrame(rows, columns=['study_id',
+                                              'redcap_event_name'] + fields)
+    return (metadata, SyntheticProject(records))
+
+
+def export_visits(project, visits, forms, outdir, export_frames=None):
+    for (subject, event) in visits:
+        subject_datadir = os.path.join(outdir, subject, event)
+        os.makedirs(subject_datadir)
+        rcpipeline.export(project, 'A', subject, event, None, 16.0,
+                          dict(mri_qa_completed='0'), 'standard',
+                          event[0:2], subject, subject_datadir, forms,
+                          select_exports=sorted(rcpipeline.export_forms.keys()),
+                          export_frames=export_frames)
+
+
+def compare_dirs(dir_a, dir_b):
+    """
+    Compare all files in two directory trees
+
+    :return: list of relative paths of files that differ or exist only once
+    """
+    mismatches = []
+    for (dirpath, dirnames, filenames) in os.walk(dir_a):
+        for fname in filenames:
+            path_a = os.path.join(dirpath, fname)
+            path_b = os.path.join(dir_b, os.path.relpath(path_a, dir_a))
+            if not os.path.exists(path_b) or \
+                    not filecmp.cmp(path_a, path_b, shallow=False):
+                mismatches.append(os.path.relpath(path_a, dir_a))
+    for (dirpath, dirnames, filenames) in os.walk(dir_b):
+        for fname in filenames:
+            path_b = os.path.join(dirpath, fname)
+            if not os.path.exists(os.path.join(dir_a,
+                                               os.path.relpath(path_b, dir_b))):
+                mismatches.append(os.path.relpath(path_b, dir_b))
+    return mismatches
+
+
+def main(args=None):
+    random.seed(args.seed)
+
+    (metadata, project) = make_project(args.subjects)
+    rcpipeline.organize_metadata(metadata)
+
+    forms = set(rcpipeline.import_forms.values())
+    visits = [(subject, event) for subject
+              in sorted(set(project.records['study_id']))
+              for event in events]
+
+    outdir = tempfile.mkdtemp()
+    try:
+        single_dir = os.path.join(outdir, 'single')
+        export_visits(project, visits, forms, single_dir)
+
+        bulk_dir = os.path.join(outdir, 'bulk')
+        prefetched_records = rcpipeline.prefetch_records(
+            project, [subject for (subject, event) in visits], events, forms,
+            chunk_size=args.chunk_size)
+        visit_codes = pandas.DataFrame(
+            [[subject, 'standard', event[0:2]] for (subject, event) in visits],
+            index=pandas.MultiIndex.from_tuples(visits),
+            columns=['subject', 'arm', 'visit']).sort_index()
+        (all_fields, export_list) = rcpipeline.get_export_fields(
+            forms, sorted(rcpipeline.export_forms.keys()))
+        export_frames = rcpipeline.make_export_frames(prefetched_records,
+                                                      visit_codes,
+                                                      export_list)
+        export_visits(None, visits, forms, bulk_dir,
+                      export_frames=export_frames)
+
+        mismatches = compare_dirs(single_dir, bulk_dir)
+        print "{0} visits exported, {1} mismatching files".format(
+            len(visits), len(mismatches))
+        if args.verbose:
+            for path in mismatches[0:10]:
+                print "  ", path
+    finally:
+        shutil.rmtree(outdir)
+
+    if mismatches:
+        return 1
+
+if __name__ == "__main__":
+    import argparse
+
+    formatter = argparse.RawDescriptionHelpFormatter
+    default = 'default: %(default)s'
+    parser = argparse.ArgumentParser(prog="check_export_paths.py",
+                                     description=__doc__,
+                                     formatter_class=formatter)
+    parser.add_argument("-n", "--subjects", dest="subjects", type=int,
+                        default=20,
+                        help="Number of synthetic subjects. {0}".format(default))
+    parser.add_argument("-c", "--chunk-size", dest="chunk_size", type=int,
+                        default=7,
+                        help="Subjects per bulk request. {0}".format(default))
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=0,
+                        help="Random seed. {0}".format(default))
+    parser.add_argument("-v", "--verbose", dest="verbose",
+                        help="Print mismatching files", action='store_true')
+    args = parser.parse_args()
+    sys.exit(main(args=args))
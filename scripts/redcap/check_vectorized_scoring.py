@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+##
+##  Copyright 2016 SRI International
+##  See COPYING file distributed along with the package for the copyright and license terms.
+##
+"""
+=========================
+Vectorized Scoring Checks
+=========================
+
+Runs the vectorized scoring functions (compute_scores) of the highrisk,
+fh_alc, fh_drug, brief, and bmi instruments and the per-record scoring
+functions they replaced on the same synthetic records, and checks that both
+produce identical output. The per-record implementations are loaded from a
+baseline revision of the scoring modules in git.
+
+BRIEF norms and BMI z-scores are not computed for subjects whose age or sex
+is unknown (the per-record implementations failed or used the wrong norms
+for them), so for these instruments it is also checked that such subjects,
+and only those, are left blank.
+
+Example Usage:
+
+python check_vectorized_scoring.py --records 2000 --instruments bmi highrisk
+"""
+
+import os
+import imp
+import sys
+import time
+import random
+import warnings
+import subprocess
+
+import numpy
+import pandas
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(script_dir, 'scoring'))
+import highrisk
+import fh_alc
+import fh_drug
+import brief
+import bmi
+
+# Values drawn for the different kinds of input fields
+complete_values = [numpy.nan, 0, 1, 2]
+missing_values = [numpy.nan, 0, 1]
+date_values = [numpy.nan, '2013-02-01', '2014-07-15', '2015-12-31', 'n/a']
+answer_values = [numpy.nan, 0, 1, 2, 3, 4, 5, 8, 10, 12, 14, 15, 17, 20, 25]
+dob_values = ['1997-03-11', '1999-10-02', 'unknown']
+sex_values = [0, 1]
+
+
+def get_random_value(field):
+    if field.endswith('complete'):
+        return random.choice(complete_values)
+    if field.endswith('missing'):
+        return random.choice(missing_values)
+    if 'date' in field or field.endswith('dotest'):
+        return random.choice(date_values)
+    return random.choice(answer_values)
+
+
+# BRIEF answers are 0..2, and all records need an interview date; birth dates
+# must be valid (or missing) dates. Records with any missing answer are not
+# scored, so answers are only rarely missing.
+brief_answer_values = [0, 1, 2, 2, 2]
+brief_date_values = ['2013-02-01', '2014-07-15', '2015-12-31']
+brief_dob_values = ['1997-03-11', '1998-08-20', '1999-10-02', '2000-01-30']
+
+
+def get_random_brief_value(field):
+    if 'date' in field:
+        return random.choice(brief_date_values)
+    if random.random() < 0.001:
+        return numpy.nan
+    return random.choice(brief_answer_values)
+
+
+# BMI inputs are height in inches, weight in pounds, and age in years. Ages
+# include whole and half months throughout the CDC table (24 to 240.5 months),
+# where the closest tabulated age can be a tie.
+bmi_height_values = [numpy.nan, 0, 55, 60.5, 64, 68, 71.25, 76]
+bmi_weight_values = [numpy.nan, 85, 110, 132.5, 150, 175, 220]
+bmi_tie_age_values = [months / 24.0 for months in range(2 * 23, 2 * 242)]
+
+
+def get_random_bmi_value(field):
+    if field.endswith('cddrheight'):
+        return random.choice(bmi_height_values)
+    if field.endswith('cddrweight'):
+        return random.choice(bmi_weight_values)
+    if field.endswith('_age'):
+        if random.random() < 0.05:
+            return numpy.nan
+        if random.random() < 0.5:
+            return random.choice(bmi_tie_age_values)
+        return round(random.uniform(1.5, 21), 2)
+    return get_random_value(field)
+
+
+# Instruments to check: name, scoring module, function that makes a random
+# value for an input field, the values of the subjects' birth dates and sex,
+# the demographics columns without which a record cannot be normed, and the
+# output fields that are left blank for such records
+instruments = [
+    ('highrisk', highrisk, get_random_value, dob_values, sex_values, [], []),
+    ('fh_alc', fh_alc, get_random_value, dob_values, sex_values, [], []),
+    ('fh_drug', fh_drug, get_random_value, dob_values, sex_values, [], []),
+    ('brief', brief, get_random_brief_value, brief_dob_values, sex_values,
+     ['dob', 'sex'], ['%s_%s' % (label, score) for score in ['t', 'p']
+                      for label in brief.labels if label != '']),
+    ('bmi', bmi, get_random_bmi_value, dob_values, sex_values,
+     ['sex'], ['bmi_zscore', 'bmi_percentile']),
+]
+
+
+def load_baseline_module(name, revision):
+    """
+    Load a scoring module as it was in a given git revision. Data files are
+    read from the current scoring module directory.
+
+    :param name: str name of the scoring module
+    :param revision: str git revision
+    :return: module
+    """
+    source = subprocess.check_output(
+        ['git', 'show', '%s:./scoring/%s/__init__.py' % (revision, name)],
+        cwd=script_dir)
+    module = imp.new_module('baseline_%s' % name)
+    module.__file__ = os.path.join(script_dir, 'scoring', name, '__init__.py')
+    exec compile(source, '%s:%s' % (revision, name), 'exec') in module.__dict__
+    return module
+
+
+def make_records(module, n_records, get_value=get_random_value,
+                 dob_values=dob_values, sex_values=sex_values):
+    """
+    Make synthetic records with all input fields of a scoring module, and
+    demographics for their subjects.
+
+    :param module: scoring module
+    :param n_records: int
+    :param get_value: function that makes a random value for a field
+    :param dob_values: list of birth dates to choose from
+    :param sex_values: list of sex codes to choose from
+    :return: tuple (`pandas.DataFrame` records, `pandas.DataFrame` demographics)
+    """
+    fields = []
+    for form_fields in module.input_fields.values():
+        for field in form_fields:
+            if field not in fields:
+                fields.append(field)
+
+    subjects = ['X-%05d-M-%d' % (i, i % 10) for i in range(n_records)]
+    index = pandas.MultiIndex.from_tuples(
+        [(subject, 'baseline_visit_arm_1') for subject in subjects],
+        names=['study_id', 'redcap_event_name'])
+    records = pandas.DataFrame(
+        dict([(field, [get_value(field) for i in range(n_records)])
+              for field in fields]), index=index, columns=fields)
+
+    demographics = pandas.DataFrame(
+        dict(dob=[random.choice(dob_values) for subject in subjects],
+             sex=[random.choice(sex_values) for subject in subjects]),
+        index=subjects)
+    return records, demographics
+
+
+def remove_demographics(demographics, columns):
+    """
+    Make the age or sex of some subjects unknown: subjects ending in "-9"
+    have no demographics, and those ending in "-7" and "-8" lack the first
+    and last of the given demographics columns, respectively.
+
+    :param demographics: `pandas.DataFrame`
+    :param columns: list of demographics columns needed for scoring
+    :return: tuple (`pandas.DataFrame` demographics, list of subjects with
+             unknown age or sex)
+    """
+    demographics = demographics.copy()
+    unknown = []
+    for subject in demographics.index:
+        if subject.endswith('-7'):
+            demographics.loc[subject, columns[0]] = numpy.nan
+        elif subject.endswith('-8'):
+            demographics.loc[subject, columns[-1]] = numpy.nan
+        elif not subject.endswith('-9'):
+            continue
+        unknown.append(subject)
+    demographics = demographics[[not subject.endswith('-9')
+                                 for subject in demographics.index]]
+    return demographics, unknown
+
+
+def compare_csv(reference, vectorized):
+    """
+    :return: list of (reference, vectorized) pairs of mismatching CSV lines
+    """
+    reference_lines = reference.to_csv().splitlines()
+    vectorized_lines = vectorized.to_csv().splitlines()
+    mismatches = [(ref, vec) for (ref, vec)
+                  in zip(reference_lines, vectorized_lines) if ref != vec]
+    if len(reference_lines) != len(vectorized_lines):
+        mismatches.append(('%d lines' % len(reference_lines),
+                           '%d lines' % len(vectorized_lines)))
+    return mismatches
+
+
+def compare_blanks(scores, scores_partial, unknown, blank_fields):
+    """
+    Check that scores computed with partial demographics are blank for the
+    subjects with unknown age or sex, and the same as with full demographics
+    for all others.
+
+    :return: list of (expected, actual) pairs of mismatching records
+    """
+    expected = scores[blank_fields].values.astype(float)
+    actual = scores_partial[blank_fields].values.astype(float)
+    expected[numpy.array(scores.index.get_level_values(0).isin(unknown))] = \
+        numpy.nan
+    same = (expected == actual) | (numpy.isnan(expected) & numpy.isnan(actual))
+    return [(str(scores.index[idx]) + ' ' + str(list(expected[idx])),
+             str(scores_partial.index[idx]) + ' ' + str(list(actual[idx])))
+            for idx in numpy.nonzero(~same.all(axis=1))[0]]
+
+
+def main(args=None):
+    random.seed(args.seed)
+
+    # Both implementations assign to columns of filtered frames, and the
+    # per-record ones use chained assignment
+    warnings.simplefilter('ignore')
+
+    failed = 0
+    for (name, module, get_value, dobs, sexes, needed_demographics,
+         blank_fields) in instruments:
+        if args.instruments and name not in args.instruments:
+            continue
+        baseline = load_baseline_module(name, args.baseline)
+        records, demographics = make_records(module, args.records,
+                                             get_value=get_value,
+                                             dob_values=dobs,
+                                             sex_values=sexes)
+
+        start = time.time()
+        reference = baseline.compute_scores(records.copy(), demographics)
+        reference_time = time.time() - start
+
+        start = time.time()
+        vectorized = module.compute_scores(records.copy(), demographics)
+        vectorized_time = time.time() - start
+
+        mismatches = compare_csv(reference, vectorized)
+        if needed_demographics and len(vectorized):
+            partial_demographics, unknown = remove_demographics(
+                demographics, needed_demographics)
+            vectorized_partial = module.compute_scores(records.copy(),
+                                                       partial_demographics)
+            mismatches += compare_blanks(vectorized, vectorized_partial,
+                                         unknown, blank_fields)
+
+        print "{0}: per-record {1:.2f}s, vectorized {2:.2f}s, " \
+              "{3} mismatches".format(name, reference_time, vectorized_time,
+                                      len(mismatches))
+        if mismatches:
+            failed += 1
+            if args.verbose:
+                for (ref, vec) in mismatches[0:10]:
+                    print "  expected:  ", ref
+                    print "  vectorized:", vec
+
+    if failed:
+        return 1
+
+if __name__ == "__main__":
+    import argparse
+
+    formatter = argparse.RawDescriptionHelpFormatter
+    default = 'default: %(default)s'
+    parser = argparse.ArgumentParser(prog="check_vectorized_scoring.py",
+                                     description=__doc__,
+                                     formatter_class=formatter)
+    parser.add_argument("-r", "--records", dest="records", type=int,
+                        default=500,
+                        help="Number of synthetic records. {0}".format(default))
+    parser.add_argument("-i", "--instruments", dest="instruments", nargs='+',
+                        help="Check only these instruments (default: all)")
+    parser.add_argument("-b", "--baseline", dest="baseline",
+                        default='f404cde',
+                        help="Git revision of the per-record scoring "
+                             "modules. {0}".format(default))
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=0,
+                        help="Random seed. {0}".format(default))
+    parser.add_argument("-v", "--verbose", dest="verbose",
+                        help="Print mismatching records", action='store_true')
+    args = parser.parse_args()
+    sys.exit(main(args=args))
@@ -8,10 +8,17 @@
 import os
 import re
 import glob
+import json
 import time
-import filecmp
+import hashlib
+import StringIO
+import threading
 
 import pandas
+import redcap
+import requests
+
+import file_utils
 
 
 # Truncate age to 2 digits for increased identity protection
@@ -23,46 +30,251 @@ def truncate_age(age_in):
         return age_in
 
 
-# "Safe" CSV export - this will catch IO errors from trying to write to a file
-# that is currently being read and will retry a number of times before giving up
-# This function will also confirm whether the newly created file is different
-# from an already existing file of the same name. Only changed files will be
-# updated.
+# Name of the file in each output directory that holds the content hashes of
+# the CSV files written there by safe_csv_export
+csv_hash_manifest_name = '.csv_hashes'
+
+# Hash manifests loaded so far, by directory, and the directories whose
+# manifests have entries that are not written to disk yet (exports may run in
+# parallel threads, so access is locked)
+csv_hash_manifests = dict()
+dirty_csv_hash_manifests = set()
+csv_hash_manifests_lock = threading.Lock()
+
+
+def get_csv_hash_manifest(dirname):
+    with csv_hash_manifests_lock:
+        if dirname not in csv_hash_manifests:
+            try:
+                with open(os.path.join(dirname, csv_hash_manifest_name),
+                          'r') as fi:
+                    csv_hash_manifests[dirname] = json.load(fi)
+            except (IOError, ValueError):
+                csv_hash_manifests[dirname] = dict()
+        return csv_hash_manifests[dirname]
+
+
+def write_csv_hash_manifest(dirname):
+    with csv_hash_manifests_lock:
+        manifest = csv_hash_manifests[dirname]
+        dirty_csv_hash_manifests.discard(dirname)
+    file_utils.atomic_write(os.path.join(dirname, csv_hash_manifest_name),
+                            json.dumps(manifest, indent=0, sort_keys=True))
+
+
+# Write the hash manifests that have entries not written to disk yet, i.e.,
+# hashes that safe_csv_export computed from existing, unchanged files. Call
+# this when all CSV files have been exported.
+def flush_csv_hash_manifests():
+    with csv_hash_manifests_lock:
+        dirnames = sorted(dirty_csv_hash_manifests)
+    for dirname in dirnames:
+        try:
+            write_csv_hash_manifest(dirname)
+        except (IOError, OSError) as e:
+            print "ERROR: failed to write hash manifest in", dirname, \
+                "with errno", e.errno
+
+
+# "Safe" CSV export - the data frame is serialized in memory and its hash
+# compared with the hash stored for the existing file of the same name, so
+# that only changed files are written. Files are written to a temporary file
+# and renamed in place, so readers of the old file are never disturbed.
 def safe_csv_export(df, fname, verbose=False):
-    success = False
-    retries = 10
+    buffer = StringIO.StringIO()
+    df.to_csv(buffer, index=False)
+    content = buffer.getvalue()
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    content_hash = hashlib.sha1(content).hexdigest()
+
+    (dirname, basename) = os.path.split(os.path.abspath(fname))
+    manifest = get_csv_hash_manifest(dirname)
+
+    if os.path.exists(fname):
+        # No hash for an existing file (e.g., written before we kept hashes) -
+        # compute it once from the file itself, and keep it for the next run
+        # (see flush_csv_hash_manifests)
+        if basename not in manifest:
+            with open(fname, 'rb') as fi:
+                manifest[basename] = hashlib.sha1(fi.read()).hexdigest()
+            with csv_hash_manifests_lock:
+                dirty_csv_hash_manifests.add(dirname)
+
+        # Equal - nothing to do
+        if manifest[basename] == content_hash:
+            return
+
+    try:
+        file_utils.atomic_write(fname, content)
+        manifest[basename] = content_hash
+        write_csv_hash_manifest(dirname)
+    except (IOError, OSError) as e:
+        print "ERROR: failed to write file", fname, "with errno", e.errno
+        return
+
+    if verbose:
+        print "Updated", fname
+
+
+# Format of the "dateRangeBegin" parameter of the REDCap record export API
+redcap_date_range_format = '%Y-%m-%d %H:%M:%S'
+
+
+def get_changed_records(redcap_project, since):
+    """
+    Get the IDs of all records created or modified in REDCap since a given time
+
+    :param redcap_project: `redcap.Project`
+    :param since: float (seconds since the epoch)
+    :return: set of record IDs, or None if REDCap could not be queried
+    """
+    payload = dict(token=redcap_project.token, content='record',
+                   format='json', type='flat',
+                   fields=redcap_project.def_field,
+                   dateRangeBegin=time.strftime(redcap_date_range_format,
+                                                time.localtime(since)))
+    try:
+        response = requests.post(redcap_project.url, data=payload,
+                                 verify=redcap_project.verify)
+        records = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print "WARNING: could not get changed records from REDCap", e
+        return None
+
+    if not isinstance(records, list):
+        print "WARNING: could not get changed records from REDCap", records
+        return None
+    return set([record[redcap_project.def_field] for record in records])
+
+
+# Make a hash of the inputs of one export, so unchanged visits can be skipped
+def hash_export_inputs(*inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True,
+                                   default=str)).hexdigest()
+
+
+# Hash of the export configuration - any change requires a full export
+def get_export_config_hash(*extra):
+    return hash_export_inputs(export_forms, export_rename, code_to_label_dict,
+                              *extra)
+
+
+# Load the state of the last incremental export
+def load_export_state(fname):
+    try:
+        with open(fname, 'r') as fi:
+            return json.load(fi)
+    except (IOError, ValueError):
+        return dict(last_run=None, config=None, visits=dict())
 
-    while (not success) and (retries > 0):
-        try:
-            df.to_csv(fname + '.new', index=False)
-            success = True
-        except IOError as e:
-            print "ERROR: failed to write file", fname, "with errno", e.errno
-            if e.errno == 11:
-                print "Retrying in 5s..."
-                time.sleep(5)
-                retries -= 1
-            else:
-                retries = 0
-
-    if success:
-        # Check if new file is equal to old file
-        if os.path.exists(fname) and filecmp.cmp(fname, fname + '.new',
-                                                 shallow=False):
-            # Equal - remove new file
-            os.remove(fname + '.new')
-        else:
-            # Not equal or no old file: put new file in its final place
-            os.rename(fname + '.new', fname)
 
+# Save the state of an incremental export
+def save_export_state(fname, state):
+    file_utils.atomic_write(fname, json.dumps(state, sort_keys=True))
+
+
+# Get the list of REDCap fields to retrieve, and the list of exports, for a
+# set of forms
+def get_export_fields(forms, select_exports=None):
+    all_fields = ['study_id']
+    export_list = []
+    for export_name in export_forms.keys():
+        if (import_forms[export_name] in forms) \
+                and (not select_exports or export_name in select_exports):
+            all_fields += [re.sub('___.*', '', field_name) for field_name in
+                           export_forms[export_name]]
+            export_list.append(export_name)
+    return (all_fields, export_list)
+
+
+# Default number of records retrieved per REDCap request by prefetch_records
+default_chunk_size = 100
+
+
+# Check whether a failed REDCap request is worth repeating with fewer records,
+# i.e., whether it timed out or the response was too large for the server or
+# the connection. Other failures (e.g., authentication errors) would only
+# repeat with smaller chunks.
+def is_size_or_timeout_error(error):
+    if isinstance(error, (requests.exceptions.Timeout,
+                          requests.exceptions.ConnectionError,
+                          requests.exceptions.ChunkedEncodingError)):
+        return True
+    return re.search('memory|too large|time.?out|timed out|gateway',
+                     str(error), re.IGNORECASE) is not None
+
+
+def prefetch_records(redcap_project, subjects, events, forms,
+                     select_exports=None, chunk_size=default_chunk_size,
+                     verbose=False):
+    """
+    Retrieve all export fields for the given subjects and events in chunked
+    requests, rather than one request per visit. If a request times out or
+    its response is too large, the chunk size is halved and the request
+    repeated.
+
+    All values are kept as strings (dtype "object"), as REDCap returned
+    them, because a frame that combines many visits would otherwise have
+    types inferred across all of them (e.g., integer codes becoming floats
+    if any visit is missing a value).
+
+    :param redcap_project: `redcap.Project`
+    :param subjects: list of study IDs
+    :param events: list of unique event names
+    :param forms: set of form names for which to retrieve the export fields
+    :param select_exports: list of export names, or None for all exports
+    :param chunk_size: int
+    :param verbose: bool
+    :return: `pandas.DataFrame` indexed by (study_id, redcap_event_name)
+    """
+    (all_fields, export_list) = get_export_fields(forms, select_exports)
+    all_fields = ['study_id'] + sorted(set(all_fields) - set(['study_id']))
+    subjects = sorted(set(subjects))
+    index_col = [redcap_project.def_field, 'redcap_event_name']
+
+    chunks = []
+    idx = 0
+    while idx < len(subjects):
+        subjects_chunk = subjects[idx:idx + chunk_size]
+        try:
+            chunks.append(redcap_project.export_records(
+                fields=all_fields, records=subjects_chunk, events=events,
+                event_name='unique', format='df',
+                df_kwargs=dict(index_col=index_col, dtype=object)))
+            idx += len(subjects_chunk)
+        except (requests.exceptions.RequestException,
+                redcap.RedcapError) as e:
+            if chunk_size == 1 or not is_size_or_timeout_error(e):
+                raise
+            chunk_size = max(1, chunk_size / 2)
             if verbose:
-                print "Updated", fname
+                print "REDCap request for %d records failed (%s) - " \
+                      "retrying with %d records per request" % (
+                          len(subjects_chunk), e, chunk_size)
+
+    if verbose:
+        print "Retrieved %d REDCap records for %d subjects in %d requests" % (
+            sum([len(chunk) for chunk in chunks]), len(subjects), len(chunks))
+
+    if len(chunks):
+        return pandas.concat(chunks)
+    else:
+        return pandas.DataFrame(columns=all_fields[1:],
+                                index=pandas.MultiIndex(levels=[[], []],
+                                                        labels=[[], []],
+                                                        names=index_col))
 
 
 # Export selected REDCap data to pipeline/distribution directory
+#
+# If "export_frames" is given, these are the output frames of all exports for
+# many visits (see make_export_frames), from which this visit's rows are taken;
+# otherwise, the data are retrieved from REDCap.
 def export(redcap_project, site, subject, event, subject_data, visit_age,
            visit_data, arm_code, visit_code, subject_code, subject_datadir,
-           forms_this_event, select_exports=None, verbose=False):
+           forms_this_event, select_exports=None, export_frames=None,
+           verbose=False):
 
     # Mark subjects/visits that have QA completed by creating a hidden marker
     # file
@@ -139,75 +351,105 @@ def export(redcap_project, site, subject, event, subject_data, visit_age,
 
     # First get data for all fields across all forms in this event - this speeds
     # up transfers over getting each form separately
-    all_fields = ['study_id']
-    export_list = []
-    for export_name in export_forms.keys():
-        if (import_forms[export_name] in forms_this_event) \
-                and (not select_exports or export_name in select_exports):
-            all_fields += [re.sub('___.*', '', field_name) for field_name in
-                           export_forms[export_name]]
-            export_list.append(export_name)
-
-    all_records = redcap_project.export_records(fields=all_fields,
-                                                records=[subject],
-                                                events=[event],
-                                                format='df')
+    (all_fields, export_list) = get_export_fields(forms_this_event,
+                                                  select_exports)
+
+    if export_frames is None:
+        all_records = redcap_project.export_records(fields=all_fields,
+                                                    records=[subject],
+                                                    events=[event],
+                                                    event_name='unique',
+                                                    format='df')
+        visit_codes = pandas.DataFrame(index=all_records.index)
+        visit_codes['subject'] = subject_code
+        visit_codes['arm'] = arm_code
+        visit_codes['visit'] = visit_code
+        export_frames = make_export_frames(all_records, visit_codes,
+                                           export_list)
 
     # Now go form by form and export data
     for export_name in export_list:
-        # Remove the complete field from the list of forms
-        complete = '{}_complete'.format(import_forms.get(export_name))
-        fields = [column for column in export_forms.get(export_name)
-                  if column != complete]
+        if export_name not in export_frames:
+            continue
 
-        # Select data for this form - "reindex_axis" is necessary to put
-        # fields in listed order - REDCap returns them lexicographically sorted
-        record = all_records[fields].reindex_axis(fields, axis=1)
+        form_frame = export_frames[export_name]
+        if (subject, event) in form_frame.index:
+            record = form_frame.loc[[(subject, event)]]
+        else:
+            record = form_frame.iloc[0:0]
 
         if len(record) == 1:
-            # First, add the three index columns
-            record.insert(0, 'subject', subject_code)
-            record.insert(1, 'arm', arm_code)
-            record.insert(2, 'visit', visit_code)
-
-            field_idx = 0
-            output_fields = []
-            for field in record.columns:
-                # Rename field for output if necessary
-                if field in export_rename[export_name].keys():
-                    output_field = export_rename[export_name][field]
-                else:
-                    output_field = field
-                output_fields.append(output_field)
-
-                # If this is an "age" field, truncate to 2 digits for privacy
-                if re.match('.*_age$', field):
-                    record[field] = record[field].apply(truncate_age)
-
-                # If this is a radio or dropdown field
-                # (except "FORM_[missing_]why"), add a separate column for the
-                # coded label
-                if field in code_to_label_dict.keys() and not re.match(
-                        '.*_why$', field):
-                    code = str(record[field].ix[0])
-                    label = ''
-                    if code in code_to_label_dict[field].keys():
-                        label = code_to_label_dict[field][code]
-                    field_idx += 1
-                    record.insert(field_idx, output_field + '_label', label)
-                    output_fields.append(output_field + '_label')
-
-                field_idx += 1
-
-            # Apply renaming to columns
-            record.columns = output_fields
-
             # Figure out path for CSV file and export this record
             safe_csv_export(record,
                             os.path.join(measures_dir, export_name + '.csv'),
                             verbose=verbose)
 
 
+# Get the string of a coded value for label lookup - integral numbers may
+# arrive as floats (e.g., 1.0), but their codes are integer strings
+def get_code_string(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# Fields of the exports that were missing from the REDCap records, so that
+# each is reported only once (exports may run in parallel threads, so access
+# is locked)
+missing_export_fields = set()
+missing_export_fields_lock = threading.Lock()
+
+
+def warn_missing_export_field(export_name, field):
+    with missing_export_fields_lock:
+        if (export_name, field) in missing_export_fields:
+            return
+        missing_export_fields.add((export_name, field))
+    print "WARNING: field '%s' of export '%s' is missing from the REDCap " \
+          "records - exporting empty values" % (field, export_name)
+
+
+# Make the output frames for a list of exports from a frame of REDCap records
+# with any number of visits. The "visit_codes" frame has the same index as the
+# records and provides the "subject", "arm", and "visit" output columns;
+# records without visit codes are dropped. Returns a dictionary that maps
+# each export name to its output frame (with the records' index).
+def make_export_frames(all_records, visit_codes, export_list):
+    visit_codes = visit_codes.reindex(all_records.index).dropna(
+        subset=['subject'])
+    all_records = all_records.loc[visit_codes.index]
+
+    export_frames = dict()
+    for export_name in export_list:
+        plan = export_plans[export_name]
+
+        columns = []
+        for (field, output_field, label_field) in plan['columns']:
+            if field in visit_codes.columns:
+                values = visit_codes[field]
+            elif field in all_records.columns:
+                values = all_records[field]
+            else:
+                warn_missing_export_field(export_name, field)
+                values = pandas.Series(index=all_records.index)
+
+            # If this is an "age" field, truncate to 2 digits for privacy
+            if field in plan['age_fields']:
+                values = values.map(truncate_age)
+            columns.append(values)
+
+            # If this is a radio or dropdown field, add the coded label
+            if label_field:
+                columns.append(values.map(get_code_string).map(
+                    code_to_label_dict[field]).fillna(''))
+
+        frame = pandas.concat(columns, axis=1)
+        frame.columns = plan['output_columns']
+        export_frames[export_name] = frame
+
+    return export_frames
+
+
 # Filter potentially confidential fields out of given list, based on project
 #  metadata
 def filter_out_confidential(field_list, metadata_dict):
@@ -268,10 +510,53 @@ def make_code_label_dict(redcap_metadata):
             code_to_label_dict[field['field_name']] = field_dict
 
 
+# Precompiled export plans - for each export, the output columns and which
+# fields need age truncation or a coded label column. These depend on the
+# (filtered) export field lists and the code-to-label lookup, so they are
+# made after both.
+export_plans = dict()
+
+
+def make_export_plans():
+    for export_name in export_forms.keys():
+        # Remove the complete field from the list of forms
+        complete = '{}_complete'.format(import_forms.get(export_name))
+        fields = ['subject', 'arm', 'visit'] + [
+            column for column in export_forms.get(export_name)
+            if column != complete]
+
+        columns = []
+        output_columns = []
+        age_fields = set()
+        for field in fields:
+            # Rename field for output if necessary
+            output_field = export_rename[export_name].get(field, field)
+            output_columns.append(output_field)
+
+            # If this is an "age" field, truncate to 2 digits for privacy
+            if re.match('.*_age$', field):
+                age_fields.add(field)
+
+            # If this is a radio or dropdown field (except "FORM_[missing_]why"),
+            # add a separate column for the coded label
+            label_field = None
+            if field in code_to_label_dict.keys() and not re.match('.*_why$',
+                                                                   field):
+                label_field = output_field + '_label'
+                output_columns.append(label_field)
+
+            columns.append((field, output_field, label_field))
+
+        export_plans[export_name] = dict(columns=columns,
+                                         output_columns=output_columns,
+                                         age_fields=age_fields)
+
+
 # Organize REDCap metadata (data dictionary)
 def organize_metadata(redcap_metadata):
     filter_all_forms(redcap_metadata)
     make_code_label_dict(redcap_metadata)
+    make_export_plans()
 
 
 # Create data dictionaries in a user-provided directory
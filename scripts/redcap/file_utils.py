@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+##
+##  Copyright 2016 SRI International
+##  See COPYING file distributed along with the package for the copyright and license terms.
+##
+"""
+==============
+File Utilities
+==============
+
+File I/O helpers shared by the REDCap scripts.
+"""
+
+import os
+import stat
+import tempfile
+
+# Permissions of newly created files under the current umask
+current_umask = os.umask(0)
+os.umask(current_umask)
+default_file_mode = 0666 & ~current_umask
+
+
+def atomic_write(fname, data):
+    """
+    Write a string to a file by writing a temporary file in the same directory
+    and renaming it in place, so readers never see a partial file
+
+    :param fname: str
+    :param data: str
+    :return: None
+    """
+    dirname = os.path.dirname(os.path.abspath(fname))
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    # Temporary files are only readable by their owner - give the new file the
+    # permissions of the file it replaces, or the default permissions
+    if os.path.exists(fname):
+        mode = stat.S_IMODE(os.stat(fname).st_mode)
+    else:
+        mode = default_file_mode
+
+    (fd, tmp_fname) = tempfile.mkstemp(dir=dirname, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as fi:
+            fi.write(data)
+        os.chmod(tmp_fname, mode)
+        os.rename(tmp_fname, fname)
+    except:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
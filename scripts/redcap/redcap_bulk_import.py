@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+##
+##  Copyright 2016 SRI International
+##  See COPYING file distributed along with the package for the copyright and license terms.
+##
+"""
+====================
+REDCap Bulk Importer
+====================
+
+Uploads records to a REDCap project in chunks that are bounded by the number
+of records and by their (JSON) size, so that large uploads neither exceed the
+server's request limits nor fail as a whole because of a single bad record.
+
+Records are queued with `add_records()` and uploaded whenever a chunk is full;
+`flush()` uploads the rest. Transient failures (connection errors, timeouts,
+server errors) are retried with exponential back-off. A chunk that REDCap
+rejects, i.e., answers with an "error" response (e.g., because a record is on
+a locked form or has an invalid value), is split in half and each half uploaded separately, until the failing records
+are isolated. The outcome of every record is kept, so that the calling script
+can report exactly which records were not uploaded and why.
+"""
+
+import ast
+import json
+import time
+
+import redcap
+import requests
+
+# Maximum number of records per import request
+default_chunk_size = 200
+
+# Maximum size of the records in one import request (in bytes of JSON)
+default_max_chunk_bytes = 1024 * 1024
+
+# Number of times a chunk is retried after a transient failure
+default_max_retries = 3
+
+# Seconds to wait before the first retry; doubled for every further retry
+default_retry_delay = 5
+
+
+def get_record_key(record, def_field):
+    """
+    Get the (record, event) key of a record dictionary
+
+    :param record: dict
+    :param def_field: str (the project's record ID field)
+    :return: tuple
+    """
+    return (record.get(def_field), record.get('redcap_event_name'))
+
+
+def get_rejection_message(response):
+    """
+    Get REDCap's error message if an import was rejected, i.e., REDCap
+    answered with an "error" response. Depending on the PyCap version, this
+    response is either returned or raised as an exception with the response
+    as its message.
+
+    :param response: dict (import response) or Exception
+    :return: str, or None if the import was not rejected
+    """
+    if isinstance(response, Exception):
+        content = None
+        for parse in (json.loads, ast.literal_eval):
+            try:
+                content = parse(str(response))
+                break
+            except (ValueError, SyntaxError):
+                pass
+    else:
+        content = response
+
+    if isinstance(content, dict) and 'error' in content:
+        return str(content['error']).replace('\\n', '\n').strip()
+    return None
+
+
+def get_error_message(error):
+    """
+    Get a readable message from a failed import request
+
+    :param error: Exception
+    :return: str
+    """
+    message = get_rejection_message(error)
+    if message is None:
+        message = str(error).replace('\\n', '\n').strip()
+    return message
+
+
+class BulkImporter(object):
+    """
+    Chunked, retrying record importer for one REDCap project
+    """
+    def __init__(self, project, overwrite='overwrite',
+                 chunk_size=default_chunk_size,
+                 max_chunk_bytes=default_max_chunk_bytes,
+                 max_retries=default_max_retries,
+                 retry_delay=default_retry_delay, on_failure=None,
+                 verbose=False):
+        self.project = project
+        self.overwrite = overwrite
+        self.chunk_size = max(1, chunk_size)
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # Function called with the key and error message of every record
+        # that could not be uploaded, as soon as its chunk is done
+        self.on_failure = on_failure
+        self.verbose = verbose
+
+        self.queue = []
+        self.queue_bytes = 0
+
+        # Number of records REDCap reported as imported
+        self.count = 0
+        # Keys of all uploaded records, and (key, error message) of all
+        # records that could not be uploaded
+        self.uploaded = []
+        self.failed = []
+
+    def add_records(self, records):
+        """
+        Queue records for upload, uploading full chunks right away
+
+        :param records: list of dict
+        :return: None
+        """
+        for record in records:
+            record_bytes = len(json.dumps(record, default=str))
+            if self.queue and \
+                    (len(self.queue) >= self.chunk_size or
+                     self.queue_bytes + record_bytes > self.max_chunk_bytes):
+                self.flush()
+            self.queue.append(record)
+            self.queue_bytes += record_bytes
+
+    def flush(self):
+        """
+        Upload all queued records
+
+        :return: None
+        """
+        chunk = self.queue
+        self.queue = []
+        self.queue_bytes = 0
+        if chunk:
+            self._import_chunk(chunk)
+
+    def _import_with_retry(self, chunk):
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.project.import_records(chunk,
+                                                   overwrite=self.overwrite)
+            except (requests.exceptions.RequestException,
+                    redcap.RedcapError) as e:
+                if get_rejection_message(e) is not None:
+                    # REDCap rejected the data - retrying will not help
+                    return {'error': get_rejection_message(e)}
+                # Connection or server error - retry after a while
+                if attempt == self.max_retries:
+                    raise
+                if self.verbose:
+                    print "Import of {0} records failed ({1}), retrying in " \
+                          "{2}s".format(len(chunk), get_error_message(e),
+                                        delay)
+                time.sleep(delay)
+                delay *= 2
+
+    def _import_chunk(self, chunk):
+        keys = [get_record_key(record, self.project.def_field)
+                for record in chunk]
+        try:
+            response = self._import_with_retry(chunk)
+        except (requests.exceptions.RequestException,
+                redcap.RedcapError) as e:
+            # The server could not be reached even after retrying
+            message = get_error_message(e)
+            for key in keys:
+                self._record_failure(key, message)
+            return
+
+        rejection = get_rejection_message(response)
+        if rejection is not None:
+            if len(chunk) > 1:
+                # Isolate the records REDCap rejects by splitting the chunk
+                half = len(chunk) / 2
+                self._import_chunk(chunk[0:half])
+                self._import_chunk(chunk[half:])
+            else:
+                self._record_failure(keys[0], rejection)
+        elif isinstance(response, dict) and 'count' in response:
+            self.count += int(response['count'])
+            self.uploaded += keys
+        else:
+            message = "Unexpected import response: %s" % str(response)
+            for key in keys:
+                self._record_failure(key, message)
+
+    def _record_failure(self, key, message):
+        self.failed.append((key, message))
+        if self.on_failure:
+            self.on_failure(key, message)
+
+
+def import_records(project, records, **kwargs):
+    """
+    Upload a list of records in chunks
+
+    :param project: `redcap.Project`
+    :param records: list of dict
+    :param kwargs: options of `BulkImporter`
+    :return: `BulkImporter` (with `count`, `uploaded`, and `failed`)
+    """
+    importer = BulkImporter(project, **kwargs)
+    importer.add_records(records)
+    importer.flush()
+    return importer
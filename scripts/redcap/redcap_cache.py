@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+##
+##  Copyright 2016 SRI International
+##  See COPYING file distributed along with the package for the copyright and license terms.
+##
+"""
+====================
+REDCap Project Cache
+====================
+
+Persistent on-disk cache of REDCap project metadata, events, arms, and the
+form-event mapping, shared by all scripts that connect to REDCap.
+
+Every script that creates a `redcap.Project` downloads the full data
+dictionary and event lists, and most then also call `export_fem()`. This
+module keeps those in a pickle file keyed by (a hash of) the project token and
+re-downloads them only when the cache is older than a maximum age, or when the
+REDCap "Manage/Design" log reports a project change since the cache was
+written.
+
+Hits and misses are counted per project in a statistics file next to the
+cache, so that the time saved can be reported, e.g.:
+
+python redcap_cache.py --stats
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import hashlib
+
+import redcap
+import requests
+
+from file_utils import atomic_write
+
+# Default location of the cache files
+default_cache_dir = os.path.join(os.path.expanduser("~"), '.cache', 'redcap')
+
+# Cached entries are refreshed after this many hours even if REDCap does not
+# report any changes
+default_max_age_hours = 24
+
+# Project attributes that are filled in by `redcap.Project.configure()`
+project_attributes = ['metadata', 'redcap_version', 'field_names', 'def_field',
+                      'field_labels', 'forms', 'events', 'arm_nums',
+                      'arm_names', 'configured']
+
+# Format of the "beginTime" parameter of the REDCap logging API
+redcap_log_time_format = '%Y-%m-%d %H:%M'
+
+
+def get_cache_key(token):
+    """
+    Make a cache key from a project token - the token itself is never written
+    to disk
+
+    :param token: str
+    :return: str
+    """
+    return hashlib.sha1(token).hexdigest()
+
+
+def project_changed_since(url, token, since, verify_ssl=False):
+    """
+    Check the project's "Manage/Design" log for entries after a given time
+
+    :param url: str
+    :param token: str
+    :param since: float (seconds since the epoch)
+    :param verify_ssl: bool
+    :return: bool, or None if the log cannot be queried (e.g., older REDCap
+             versions or missing logging rights)
+    """
+    payload = dict(token=token, content='log', logtype='manage', format='json',
+                   beginTime=time.strftime(redcap_log_time_format,
+                                           time.localtime(since)))
+    try:
+        response = requests.post(url, data=payload, verify=verify_ssl)
+        log = response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+    if not isinstance(log, list):
+        return None
+    return len(log) > 0
+
+
+class RedcapCache(object):
+    """
+    Cache of project metadata and form-event mapping for one REDCap project
+    """
+    def __init__(self, url, token, cache_dir=default_cache_dir,
+                 max_age_hours=default_max_age_hours, verify_ssl=False,
+                 verbose=False):
+        self.url = url
+        self.token = token
+        self.verify_ssl = verify_ssl
+        self.verbose = verbose
+        self.max_age = max_age_hours * 3600
+        self.key = get_cache_key(token)
+        self.cache_dir = cache_dir
+        self.cache_file = os.path.join(cache_dir, '%s.pickle' % self.key)
+        self.stats_file = os.path.join(cache_dir, 'stats.json')
+        self.entry = None
+
+    def _load(self):
+        try:
+            with open(self.cache_file, 'rb') as fi:
+                return pickle.load(fi)
+        except:
+            return None
+
+    def _is_valid(self, entry):
+        if not entry:
+            return False
+
+        age = time.time() - entry['created']
+        if age > self.max_age:
+            return False
+
+        changed = project_changed_since(self.url, self.token,
+                                        entry['created'], self.verify_ssl)
+        # If REDCap cannot tell us, fall back to the maximum age alone
+        return not changed
+
+    def _update_stats(self, hit, seconds):
+        try:
+            with open(self.stats_file, 'r') as fi:
+                stats = json.load(fi)
+        except:
+            stats = dict()
+
+        this_project = stats.setdefault(self.key, dict(hits=0, misses=0,
+                                                       fetch_seconds=0.0,
+                                                       saved_seconds=0.0))
+        if hit:
+            this_project['hits'] += 1
+            this_project['saved_seconds'] += max(
+                0.0, this_project['fetch_seconds'] - seconds)
+        else:
+            this_project['misses'] += 1
+            this_project['fetch_seconds'] = seconds
+        this_project['last_access'] = time.strftime('%Y-%m-%d %H:%M:%S')
+
+        try:
+            atomic_write(self.stats_file, json.dumps(stats, indent=2,
+                                                     sort_keys=True))
+        except (IOError, OSError) as e:
+            print "WARNING: could not update REDCap cache statistics", e
+
+    def _fetch(self):
+        project = redcap.Project(self.url, self.token,
+                                 verify_ssl=self.verify_ssl)
+        entry = dict(created=time.time(),
+                     attributes=dict([(a, getattr(project, a, None))
+                                      for a in project_attributes]),
+                     fem=project.export_fem(format='df'))
+        try:
+            atomic_write(self.cache_file, pickle.dumps(entry, protocol=2))
+        except (IOError, OSError) as e:
+            print "WARNING: could not write REDCap cache file", \
+                self.cache_file, e
+        return entry
+
+    def get_entry(self):
+        """
+        Get the cached metadata entry, refreshing it from REDCap if necessary
+
+        :return: dict
+        """
+        if self.entry:
+            return self.entry
+
+        start = time.time()
+        entry = self._load()
+        hit = self._is_valid(entry)
+        if not hit:
+            if self.verbose:
+                print "REDCap metadata cache miss - downloading metadata"
+            entry = self._fetch()
+        elif self.verbose:
+            print "REDCap metadata cache hit - using", self.cache_file
+
+        self._update_stats(hit, time.time() - start)
+        self.entry = entry
+        return entry
+
+    def get_project(self):
+        """
+        Get a `redcap.Project` configured from the cached metadata
+
+        :return: `redcap.Project`
+        """
+        entry = self.get_entry()
+        project = redcap.Project(self.url, self.token,
+                                 verify_ssl=self.verify_ssl, lazy=True)
+        for (attribute, value) in entry['attributes'].iteritems():
+            setattr(project, attribute, value)
+        return project
+
+    def get_fem(self):
+        """
+        Get the cached form-event mapping
+
+        :return: `pandas.DataFrame`
+        """
+        return self.get_entry()['fem'].copy()
+
+
+# Caches opened by this process, so repeated calls share one entry
+open_caches = dict()
+
+
+def get_cache(url, token, verify_ssl=False, verbose=False):
+    key = get_cache_key(token)
+    if key not in open_caches:
+        open_caches[key] = RedcapCache(url, token, verify_ssl=verify_ssl,
+                                       verbose=verbose)
+    return open_caches[key]
+
+
+def connect(url, token, verify_ssl=False, verbose=False):
+    """
+    Drop-in replacement for `redcap.Project(url, token, verify_ssl=...)` that
+    uses the cached project metadata
+
+    :param url: str
+    :param token: str
+    :param verify_ssl: bool
+    :param verbose: bool
+    :return: `redcap.Project`
+    """
+    return get_cache(url, token, verify_ssl, verbose).get_project()
+
+
+def export_fem(project):
+    """
+    Drop-in replacement for `project.export_fem(format='df')` that uses the
+    cached form-event mapping
+
+    :param project: `redcap.Project`
+    :return: `pandas.DataFrame`
+    """
+    return get_cache(project.url, project.token, project.verify).get_fem()
+
+
+def main(args=None):
+    if not args or not args.stats:
+        return
+
+    try:
+        with open(os.path.join(args.cache_dir, 'stats.json'), 'r') as fi:
+            stats = json.load(fi)
+    except IOError:
+        print "No REDCap cache statistics in", args.cache_dir
+        return
+
+    for (key, project_stats) in sorted(stats.iteritems()):
+        print "{0}: {1} hits, {2} misses, {3:.1f}s fetch time, " \
+              "{4:.1f}s saved (last access {5})".format(
+                  key[0:6], project_stats['hits'], project_stats['misses'],
+                  project_stats['fetch_seconds'],
+                  project_stats['saved_seconds'],
+                  project_stats.get('last_access'))
+
+if __name__ == "__main__":
+    import argparse
+
+    formatter = argparse.RawDescriptionHelpFormatter
+    default = 'default: %(default)s'
+    parser = argparse.ArgumentParser(prog="redcap_cache.py",
+                                     description=__doc__,
+                                     formatter_class=formatter)
+    parser.add_argument("--stats", dest="stats", action="store_true",
+                        help="Print cache hit/miss statistics")
+    parser.add_argument("--cache-dir", dest="cache_dir",
+                        default=default_cache_dir,
+                        help="Cache directory. {0}".format(default))
+    args = parser.parse_args()
+    sys.exit(main(args=args))
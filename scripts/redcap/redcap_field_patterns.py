@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+##
+##  Copyright 2016 SRI International
+##  See COPYING file distributed along with the package for the copyright and license terms.
+##
+"""
+============================
+REDCap Field Pattern Matcher
+============================
+
+Resolves the field name patterns of the scoring instruments (regular
+expressions matched at the start of REDCap field names) against the fields of
+a project.
+
+Field names are kept sorted, so that all fields starting with a pattern's
+literal prefix are found by binary search; only those candidates are matched
+against the full expression, and patterns without special characters need no
+regular expression at all. Resolved field lists are cached on disk per
+metadata version (a hash of the project's field names and the instruments'
+patterns).
+"""
+
+import os
+import re
+import json
+import bisect
+import hashlib
+
+import redcap_cache
+import file_utils
+
+# Characters that end the literal prefix of a regular expression
+regex_special_chars = '.^$*+?{}[]\\|()'
+
+# Quantifiers that make the preceding character optional
+regex_optional_quantifiers = '*?{'
+
+
+def get_literal_prefix(pattern):
+    """
+    Get the part of a pattern that every field it matches must start with
+
+    :param pattern: str
+    :return: str
+    """
+    # An alternative anywhere in the pattern can start with anything
+    if '|' in pattern:
+        return ''
+
+    for (idx, char) in enumerate(pattern):
+        if char in regex_special_chars:
+            if char in regex_optional_quantifiers:
+                return pattern[0:max(0, idx - 1)]
+            return pattern[0:idx]
+    return pattern
+
+
+def is_literal(pattern):
+    return get_literal_prefix(pattern) == pattern
+
+
+def get_metadata_version(field_names, patterns_by_instrument):
+    """
+    Make a key for the field names of a project and the patterns of a set of
+    instruments
+
+    :param field_names: list of str
+    :param patterns_by_instrument: dict of instrument -> list of str
+    :return: str
+    """
+    version = hashlib.sha1()
+    for name in field_names:
+        version.update(name + '\n')
+    for (instrument, patterns) in sorted(patterns_by_instrument.iteritems()):
+        version.update('\n%s\n' % instrument)
+        for pattern in patterns:
+            version.update(pattern + '\n')
+    return version.hexdigest()
+
+
+class FieldPatternResolver(object):
+    """
+    Matches field name patterns against a fixed list of field names
+    """
+    def __init__(self, field_names):
+        self.field_names = sorted(field_names)
+        self.resolved = dict()
+
+    def get_fields_with_prefix(self, prefix):
+        start = bisect.bisect_left(self.field_names, prefix)
+        end = start
+        while end < len(self.field_names) and \
+                self.field_names[end].startswith(prefix):
+            end += 1
+        return self.field_names[start:end]
+
+    def match(self, pattern):
+        """
+        Get all fields matched by a pattern, in field name order
+
+        :param pattern: str
+        :return: list of str
+        """
+        if pattern not in self.resolved:
+            candidates = self.get_fields_with_prefix(get_literal_prefix(pattern))
+            if not is_literal(pattern):
+                regex = re.compile(pattern)
+                candidates = [field for field in candidates
+                              if regex.match(field)]
+            self.resolved[pattern] = candidates
+        return self.resolved[pattern]
+
+    def resolve(self, patterns):
+        """
+        Find all fields matching a list of patterns. A pattern that matches
+        no field is assumed to be a field that is not in the field list (e.g.,
+        a form's "complete" field) and is included as-is.
+
+        :param patterns: list of str
+        :return: set of str
+        """
+        matches = set()
+        for pattern in patterns:
+            pattern_matches = self.match(pattern)
+            if pattern_matches:
+                matches.update(pattern_matches)
+            else:
+                matches.add(pattern)
+        return matches
+
+
+def resolve_instrument_fields(field_names, fields_list, cache_dir=None):
+    """
+    Resolve the input field patterns of all instruments in one pass
+
+    :param field_names: list of str (the project's field names)
+    :param fields_list: dict of instrument -> dict of form -> list of patterns
+    :param cache_dir: str (default: REDCap cache directory; '' to disable)
+    :return: dict of instrument -> set of field names
+    """
+    patterns_by_instrument = dict()
+    for (instrument, forms) in fields_list.iteritems():
+        patterns_by_instrument[instrument] = []
+        for patterns in forms.values():
+            patterns_by_instrument[instrument] += patterns
+
+    if cache_dir is None:
+        cache_dir = redcap_cache.default_cache_dir
+    cache_file = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, 'fields_%s.json' %
+                                  get_metadata_version(field_names,
+                                                       patterns_by_instrument))
+        try:
+            with open(cache_file, 'r') as fi:
+                cached = json.load(fi)
+            return dict([(instrument, set(fields))
+                         for (instrument, fields) in cached.iteritems()])
+        except (IOError, ValueError):
+            pass
+
+    resolver = FieldPatternResolver(field_names)
+    resolved = dict([(instrument, resolver.resolve(patterns))
+                     for (instrument, patterns)
+                     in patterns_by_instrument.iteritems()])
+
+    if cache_file:
+        try:
+            file_utils.atomic_write(cache_file, json.dumps(
+                dict([(instrument, sorted(fields))
+                      for (instrument, fields) in resolved.iteritems()])))
+        except (IOError, OSError) as e:
+            print "WARNING: could not write field pattern cache", cache_file, e
+
+    return resolved
@@ -30,7 +30,7 @@ import ConfigParser
 import pandas as pd
 from pandas.io.sql import execute
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 
 
 def create_connection(cfg):
@@ -234,6 +234,130 @@ def report_locked_forms(site_id, xnat_id, forms, project_name,
     return dataframe
 
 
+def load_id_tables(engine):
+    """
+    Load the (small) tables needed to look up project, arm, and event IDs, so
+    that many lookups can be made without querying the database each time
+
+    :param engine: `sqlalchemy.Engine`
+    :return: dict of `pandas.DataFrame`
+    """
+    return dict(projects=pd.read_sql_table('redcap_projects', engine),
+                arms=pd.read_sql_table('redcap_events_arms', engine),
+                events=pd.read_sql_table('redcap_events_metadata', engine))
+
+
+def lookup_event_ids(project_name, arm_name, event_descrip, id_tables):
+    """
+    Get the project_id and event_id for a project, arm, and event from
+    preloaded ID tables (see load_id_tables)
+
+    :param project_name: str
+    :param arm_name: str
+    :param event_descrip: str
+    :param id_tables: dict of `pandas.DataFrame`
+    :return: tuple (int, int)
+    :raises KeyError: if the project, arm, or event does not exist
+    """
+    def get_unique_id(ids, description):
+        if len(ids) != 1:
+            raise KeyError("no unique {0} in REDCap database".format(
+                description))
+        return int(ids.iloc[0])
+
+    projects = id_tables['projects']
+    project_id = get_unique_id(
+        projects[projects.project_name == project_name].project_id,
+        "project '{0}'".format(project_name))
+    arms = id_tables['arms']
+    arm_id = get_unique_id(
+        arms[(arms.arm_name == arm_name) &
+             (arms.project_id == project_id)].arm_id,
+        "arm '{0}' in project '{1}'".format(arm_name, project_name))
+    events = id_tables['events']
+    event_id = get_unique_id(
+        events[(events.descrip == event_descrip) &
+               (events.arm_id == arm_id)].event_id,
+        "event '{0}' in arm '{1}'".format(event_descrip, arm_name))
+    return project_id, event_id
+
+
+def get_locked_records_by_event(project_name, arm_name, event_descrip, engine,
+                                id_tables=None):
+    """
+    Get a dataframe of all locked forms for a specific event with a single
+    filtered query, rather than reading the whole locking table
+
+    :param project_name: str
+    :param arm_name: str
+    :param event_descrip: str
+    :param engine: `sqlalchemy.Engine`
+    :param id_tables: dict of `pandas.DataFrame` (see load_id_tables)
+    :return: `pandas.DataFrame`
+    """
+    if id_tables is None:
+        id_tables = load_id_tables(engine)
+    project_id, event_id = lookup_event_ids(project_name, arm_name,
+                                            event_descrip, id_tables)
+    sql = "SELECT record, form_name, timestamp " \
+          "FROM redcap_locking_data " \
+          "WHERE project_id = :project_id " \
+          "AND event_id = :event_id;"
+    return pd.read_sql(text(sql), engine,
+                       params=dict(project_id=project_id, event_id=event_id),
+                       parse_dates=['timestamp'])
+
+
+def make_locked_forms_report(site_id, xnat_id, forms, arm_name, event_descrip,
+                             locked_forms):
+    """
+    Make the locked forms report for a single subject from the locked forms
+    of its event (see get_locked_records_by_event)
+
+    :param site_id: str (e.g., X-12345-G-6)
+    :param xnat_id: str (e.g., NCANDA_S12345)
+    :param forms: list
+    :param arm_name: str (e.g., Standard)
+    :param event_descrip: str (e.g., Baseline)
+    :param locked_forms: `pandas.DataFrame`
+    :return: `pandas.DataFrame`
+    """
+    columns = ['subject', 'arm', 'visit'] + list(forms)
+    data = dict(subject=xnat_id, arm=arm_name.lower(), visit=event_descrip.lower())
+    dataframe = pd.DataFrame(data=data, index=[0], columns=columns)
+    locked_forms = locked_forms[locked_forms.record == site_id]
+    for form_name, timestamp in zip(locked_forms.form_name,
+                                    locked_forms.timestamp):
+        dataframe.set_value(0, form_name, timestamp)
+    return dataframe
+
+
+def report_locked_forms_batch(subjects, forms, project_name, arm_name,
+                              event_descrip, engine, id_tables=None):
+    """
+    Generate the locked forms reports for many subjects in the same event,
+    using one database query for all of them
+
+    :param subjects: list of (site_id, xnat_id) tuples
+    :param forms: list
+    :param project_name: str (e.g., data_entry)
+    :param arm_name: str (e.g., Standard)
+    :param event_descrip: str (e.g., Baseline)
+    :param engine: `sqlalchemy.Engine`
+    :param id_tables: dict of `pandas.DataFrame` (see load_id_tables)
+    :return: dict of `pandas.DataFrame` by site_id
+    """
+    locked_forms = get_locked_records_by_event(project_name, arm_name,
+                                               event_descrip, engine,
+                                               id_tables=id_tables)
+    locked_by_record = dict(list(locked_forms.groupby('record')))
+    no_locked_forms = locked_forms.iloc[0:0]
+    return dict([(site_id, make_locked_forms_report(
+                  site_id, xnat_id, forms, arm_name, event_descrip,
+                  locked_by_record.get(site_id, no_locked_forms)))
+                 for (site_id, xnat_id) in subjects])
+
+
 def main(args=None):
     if args:
         if args.verbose:
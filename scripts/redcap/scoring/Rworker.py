@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+##
+##  Copyright 2016 SRI International
+##  See COPYING file distributed along with the package for the copyright and license terms.
+##
+
+import os
+import time
+import Queue
+import select
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
+
+Rscript_binary = '/usr/bin/Rscript'
+module_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Number of R processes in a pool
+default_pool_size = min( 4, multiprocessing.cpu_count() )
+
+# Seconds to wait for R to score one record before the worker is restarted
+default_timeout = 60
+
+# Idle workers are pinged before use if they have not been used for this many seconds
+health_check_interval = 60
+
+# Raised when R fails to score a record, crashes, or times out
+class RWorkerError( Exception ):
+    pass
+
+# One long-lived R process running "Rworker.R"
+class RWorker( object ):
+    def __init__( self, scripts=[], timeout=default_timeout ):
+        self.scripts = list( scripts )
+        self.timeout = timeout
+        self.process = None
+        self.stderr = None
+        self.buffer = ''
+        self.last_used = time.time()
+        self.start()
+
+    def start( self ):
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen( [ Rscript_binary, os.path.join( module_dir, 'Rworker.R' ) ] + self.scripts,
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr )
+        self.buffer = ''
+
+    def stop( self ):
+        if self.is_alive():
+            try:
+                self._send( 'quit', '-', '' )
+                self.process.stdin.close()
+            except RWorkerError:
+                pass
+            # Give R a moment to exit by itself
+            for i in range( 10 ):
+                if not self.is_alive():
+                    break
+                time.sleep( 0.1 )
+            if self.is_alive():
+                self.process.kill()
+                self.process.wait()
+        self.stderr.close()
+
+    def restart( self ):
+        if self.is_alive():
+            self.process.kill()
+            self.process.wait()
+        self.stderr.close()
+        self.start()
+
+    def is_alive( self ):
+        return self.process is not None and self.process.poll() is None
+
+    # Discard what R wrote to stderr for earlier requests, so that the file does
+    # not grow for the lifetime of the worker. R shares the file offset, so it
+    # continues writing at the start of the file.
+    def _clear_stderr( self ):
+        fd = self.stderr.fileno()
+        os.lseek( fd, 0, os.SEEK_SET )
+        os.ftruncate( fd, 0 )
+
+    # Last lines R wrote to stderr for the current request, for error messages
+    def get_stderr( self ):
+        self.stderr.seek( 0 )
+        return '\n'.join( self.stderr.read().splitlines()[-10:] )
+
+    def _send( self, command, argument, payload ):
+        try:
+            self.process.stdin.write( '%s %s %d\n' % ( command, argument, len( payload ) ) )
+            self.process.stdin.write( payload )
+            self.process.stdin.flush()
+        except IOError as e:
+            raise RWorkerError( "could not send request to R worker: %s\n%s" % ( e, self.get_stderr() ) )
+
+    # Read more output from R, waiting until the deadline at most
+    def _fill_buffer( self, deadline ):
+        fd = self.process.stdout.fileno()
+        remaining = deadline - time.time()
+        if remaining <= 0 or not select.select( [fd], [], [], remaining )[0]:
+            raise RWorkerError( "R worker timed out after %d seconds" % self.timeout )
+        data = os.read( fd, 65536 )
+        if not data:
+            raise RWorkerError( "R worker exited unexpectedly\n%s" % self.get_stderr() )
+        self.buffer += data
+
+    def _receive( self, deadline ):
+        while '\n' not in self.buffer:
+            self._fill_buffer( deadline )
+        ( header, self.buffer ) = self.buffer.split( '\n', 1 )
+        ( status, nbytes ) = header.rsplit( ' ', 1 )
+        nbytes = int( nbytes )
+        while len( self.buffer ) < nbytes:
+            self._fill_buffer( deadline )
+        ( payload, self.buffer ) = ( self.buffer[:nbytes], self.buffer[nbytes:] )
+        return ( status, payload )
+
+    # Send one request and wait for the response. If anything goes wrong, the
+    # state of the R process is unknown, so it is replaced by a new one.
+    def request( self, command, argument, payload='' ):
+        if not self.is_alive():
+            self.restart()
+
+        self.last_used = time.time()
+        self._clear_stderr()
+        try:
+            self._send( command, argument, payload )
+            return self._receive( self.last_used + self.timeout )
+        except RWorkerError:
+            self.restart()
+            raise
+        except ValueError:
+            self.restart()
+            raise RWorkerError( "R worker sent malformed response" )
+
+    def ping( self ):
+        try:
+            return self.request( 'ping', '-' )[0] == 'pong'
+        except RWorkerError:
+            return False
+
+    # Score one record; "data" is the input CSV, the scores CSV is returned
+    def score( self, Rscript, data ):
+        ( status, payload ) = self.request( 'score', Rscript, data )
+        if status != 'ok':
+            raise RWorkerError( payload )
+        return payload
+
+# Pool of R workers - workers are started when first needed, checked before
+# use if they have been idle for a while, and restarted if they crash or time out
+class RWorkerPool( object ):
+    def __init__( self, size=default_pool_size, scripts=[], timeout=default_timeout ):
+        self.size = max( 1, size )
+        self.scripts = list( scripts )
+        self.timeout = timeout
+        self.idle = Queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def _acquire( self ):
+        try:
+            worker = self.idle.get_nowait()
+        except Queue.Empty:
+            with self.lock:
+                if len( self.workers ) < self.size:
+                    worker = RWorker( self.scripts, self.timeout )
+                    self.workers.append( worker )
+                    return worker
+            worker = self.idle.get()
+
+        if time.time() - worker.last_used > health_check_interval and not worker.ping():
+            worker.restart()
+        return worker
+
+    def _release( self, worker ):
+        self.idle.put( worker )
+
+    def score( self, Rscript, data ):
+        worker = self._acquire()
+        try:
+            return worker.score( Rscript, data )
+        finally:
+            self._release( worker )
+
+    # Score many records with the same R script in parallel; returns a list of
+    # (scores CSV, None) or (None, error message) tuples in input order
+    def score_many( self, Rscript, data_list ):
+        def score_one( data ):
+            try:
+                return ( self.score( Rscript, data ), None )
+            except RWorkerError as e:
+                return ( None, str( e ) )
+
+        if self.size == 1 or len( data_list ) < 2:
+            return map( score_one, data_list )
+
+        pool = ThreadPool( min( self.size, len( data_list ) ) )
+        try:
+            return pool.map( score_one, data_list )
+        finally:
+            pool.close()
+            pool.join()
+
+    def close( self ):
+        with self.lock:
+            for worker in self.workers:
+                worker.stop()
+            self.workers = []
+            self.idle = Queue.Queue()
@@ -6,12 +6,18 @@
 ##
 
 import re
+import glob
+import atexit
 import tempfile
 import subprocess
 import shutil
 import os.path
+import StringIO
+import threading
 import pandas
 
+import Rworker
+
 # Label translation function - LimeSurvey to SRI/old REDCap style
 def label_to_sri( prefix, ls_label ):
     return "%s_%s" % (prefix, re.sub( '_$', '', re.sub( '[_\W]+', '_', re.sub( 'subjid', 'subject_id', ls_label.lower() ) ) ) )
@@ -49,3 +55,62 @@ def runscript( row, Rscript=None, scores_key=None ):
 
     return scores_df
 
+# Pool of long-lived R processes shared by all instruments, started on first use.
+# The pool lives as long as the scoring process and is closed when it exits, so
+# each run of the scoring scripts still starts (up to "worker_pool_size") R
+# processes once - but no longer one for every record.
+worker_pool = None
+worker_pool_lock = threading.Lock()
+worker_pool_size = Rworker.default_pool_size
+worker_timeout = Rworker.default_timeout
+
+def get_worker_pool():
+    global worker_pool
+    with worker_pool_lock:
+        if worker_pool is None:
+            module_dir = os.path.dirname(os.path.abspath(__file__))
+            worker_pool = Rworker.RWorkerPool( size=worker_pool_size, scripts=sorted( glob.glob( os.path.join( module_dir, '*', '*.R' ) ) ), timeout=worker_timeout )
+            atexit.register( worker_pool.close )
+    return worker_pool
+
+# Score all records in a data frame with the R worker pool. "read_scores"
+# turns the scores CSV of one record into a Series. Records for which R
+# failed are dropped.
+def run_batch( data, Rscript, read_scores ):
+    if len( data ) == 0:
+        return pandas.DataFrame()
+
+    inputs = []
+    for ( key, row ) in data.iterrows():
+        data_csv = StringIO.StringIO()
+        pandas.DataFrame( row ).T.to_csv( data_csv )
+        inputs.append( data_csv.getvalue() )
+
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    results = get_worker_pool().score_many( os.path.join( module_dir, Rscript ), inputs )
+
+    scores_list = []
+    scored = []
+    for ( idx, ( key, ( scores_csv, error ) ) ) in enumerate( zip( data.index, results ) ):
+        if error:
+            print "R failed to score record",key,"with error",error
+        else:
+            scores_list.append( read_scores( StringIO.StringIO( scores_csv ) ) )
+            scored.append( idx )
+
+    if len( scored ) == 0:
+        return pandas.DataFrame()
+
+    scores = pandas.DataFrame( [ s.values for s in scores_list ], columns=scores_list[0].index )
+    scores.index = data.index[scored]
+    return scores
+
+# Score all records in a data frame - same result as
+# "data.apply( runscript, axis=1, Rscript=..., scores_key=... )", but without
+# starting R for every record
+def runscript_batch( data, Rscript=None, scores_key=None ):
+    def read_scores( scores_csv ):
+        scores = pandas.read_csv( scores_csv, index_col=0 )
+        return pandas.Series( data = scores.to_dict()[scores_key] )
+
+    return run_batch( data, Rscript, read_scores )
@@ -12,6 +12,8 @@ import shutil
 import os.path
 import pandas
 
+import Rwrapper
+
 # Label translation function - LimeSurvey to SRI/old REDCap style
 def label_to_sri( prefix, ls_label ):
     return "%s_%s" % (prefix, re.sub( '_$', '', re.sub( '[_\W]+', '_', re.sub( 'subjid', 'subject_id', ls_label.lower() ) ) ) )
@@ -47,3 +49,12 @@ def runscript( row, Rscript=None ):
     shutil.rmtree( tmpdir )
 
     return scores.ix[0]
+
+# Score all records in a data frame - same result as
+# "data.apply( runscript, axis=1, Rscript=... )", but without starting R for
+# every record
+def runscript_batch( data, Rscript=None ):
+    def read_scores( scores_csv ):
+        return pandas.read_csv( scores_csv, index_col=None ).ix[0]
+
+    return Rwrapper.run_batch( data, Rscript, read_scores )
@@ -5,30 +5,143 @@
 ##  See COPYING file distributed along with the package for the copyright and license terms.
 ##
 
-fields_list = dict()
-functions = dict()
-output_form = dict()
-instrument_list = []
+#
+# Registry of scoring instruments. Instruments are found by listing the subdirectories of this package, but their
+# modules are only imported when an instrument is actually scored - some of them read lookup tables or import
+# SciPy at import time. The input fields and output form of each instrument are kept in a metadata cache, so
+# that they can be looked up without importing the module; the cache entry of an instrument is refreshed
+# whenever its code (or the shared R wrapper code) changes.
+#
 
 import os
+import sys
+import imp
+import json
+import stat
+import glob
+import hashlib
+import tempfile
+import threading
+
 module_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append( module_dir )
 
-import glob
-import stat
-instruments = [ os.path.basename( d ) for d in glob.glob( os.path.join( module_dir, '*' ) ) if stat.S_ISDIR( os.stat( d ).st_mode ) and os.path.exists( os.path.join( d, '__init__.py' ) ) ]
+# Cache of instrument metadata (input fields and output form)
+metadata_cache_file = os.path.join( os.path.expanduser("~"), '.cache', 'redcap', 'scoring_metadata.json' )
 
-import sys
-sys.path.append( os.path.abspath( os.path.dirname( __file__ ) ) )
+# Modules shared by instruments - changes to these invalidate the metadata of all instruments
+shared_modules = [ 'Rwrapper.py', 'RwrapperNew.py' ]
 
-import imp
-for i in instruments:
-#    try:
-        module_found = imp.find_module( i, [module_dir] )
-        module = imp.load_module( i, module_found[0], module_found[1], module_found[2] )
-
-        instrument_list.append( i )
-        fields_list[i] =  module.input_fields
-        functions[i] = module.compute_scores
-        output_form[i] = module.output_form
-#    except:
-#        sys.exit( "ERROR: could not import scoring module '%s'" % i )
+instrument_list = sorted( [ os.path.basename( d ) for d in glob.glob( os.path.join( module_dir, '*' ) ) if stat.S_ISDIR( os.stat( d ).st_mode ) and os.path.exists( os.path.join( d, '__init__.py' ) ) ] )
+
+# Imported instrument modules
+modules = dict()
+modules_lock = threading.RLock()
+
+# Import an instrument's module, if this has not been done yet
+def load_instrument( instrument ):
+    with modules_lock:
+        if instrument not in modules:
+            module_found = imp.find_module( instrument, [module_dir] )
+            try:
+                modules[instrument] = imp.load_module( instrument, module_found[0], module_found[1], module_found[2] )
+            finally:
+                if module_found[0]:
+                    module_found[0].close()
+        return modules[instrument]
+
+# Version of an instrument's code: a hash of its Python files and the shared modules
+def get_code_version( instrument ):
+    version = hashlib.sha1()
+    instrument_files = glob.glob( os.path.join( module_dir, instrument, '*.py' ) )
+    for fname in sorted( instrument_files ) + [ os.path.join( module_dir, m ) for m in shared_modules ]:
+        version.update( os.path.basename( fname ) )
+        with open( fname, 'rb' ) as fi:
+            version.update( fi.read() )
+    return version.hexdigest()
+
+# JSON turns all strings into unicode - turn field and form names back into plain strings
+def to_str( value ):
+    if isinstance( value, dict ):
+        return dict( [ ( to_str( k ), to_str( v ) ) for ( k, v ) in value.iteritems() ] )
+    if isinstance( value, list ):
+        return [ to_str( v ) for v in value ]
+    if isinstance( value, unicode ):
+        return str( value )
+    return value
+
+def read_metadata_cache():
+    try:
+        with open( metadata_cache_file, 'r' ) as fi:
+            return to_str( json.load( fi ) )
+    except ( IOError, ValueError ):
+        return dict()
+
+def write_metadata_cache( metadata ):
+    dirname = os.path.dirname( metadata_cache_file )
+    try:
+        if not os.path.exists( dirname ):
+            os.makedirs( dirname )
+        ( fd, tmp_fname ) = tempfile.mkstemp( dir=dirname, prefix='.tmp_' )
+        with os.fdopen( fd, 'w' ) as fi:
+            json.dump( metadata, fi, sort_keys=True )
+        os.rename( tmp_fname, metadata_cache_file )
+    except ( IOError, OSError ) as e:
+        print "WARNING: could not write scoring metadata cache", metadata_cache_file, e
+
+# Cached metadata, validated against the current code of each instrument
+metadata = None
+metadata_lock = threading.RLock()
+
+def get_metadata( instrument ):
+    global metadata
+    with metadata_lock:
+        if metadata is None:
+            metadata = read_metadata_cache()
+
+        version = get_code_version( instrument )
+        if metadata.get( instrument, dict() ).get( 'version' ) != version:
+            module = load_instrument( instrument )
+            metadata[instrument] = dict( version=version, input_fields=module.input_fields, output_form=module.output_form )
+            write_metadata_cache( metadata )
+        return metadata[instrument]
+
+# Read-only dictionary of instrument -> value that computes values on first access
+class InstrumentRegistry( object ):
+    def __init__( self, get_value ):
+        self.get_value = get_value
+        self.values = dict()
+
+    def __getitem__( self, instrument ):
+        if instrument not in instrument_list:
+            raise KeyError( instrument )
+        if instrument not in self.values:
+            self.values[instrument] = self.get_value( instrument )
+        return self.values[instrument]
+
+    def __contains__( self, instrument ):
+        return instrument in instrument_list
+
+    def __iter__( self ):
+        return iter( instrument_list )
+
+    def __len__( self ):
+        return len( instrument_list )
+
+    def get( self, instrument, default=None ):
+        if instrument in instrument_list:
+            return self[instrument]
+        return default
+
+    def keys( self ):
+        return list( instrument_list )
+
+    def items( self ):
+        return [ ( instrument, self[instrument] ) for instrument in instrument_list ]
+
+    def iteritems( self ):
+        return iter( self.items() )
+
+fields_list = InstrumentRegistry( lambda instrument: get_metadata( instrument )['input_fields'] )
+output_form = InstrumentRegistry( lambda instrument: get_metadata( instrument )['output_form'] )
+functions = InstrumentRegistry( lambda instrument: load_instrument( instrument ).compute_scores )
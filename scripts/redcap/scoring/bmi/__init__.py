@@ -30,35 +30,57 @@ module_dir = os.path.dirname(os.path.abspath(__file__))
 bmi_lookup_table = pandas.io.parsers.read_csv( os.path.join( module_dir, 'bmiagerev.csv' ), header=0 )
 bmi_lookup_table = bmi_lookup_table[ [ 'Sex', 'Agemos', 'L', 'M', 'S' ] ]
 
+# Lookup table columns for each sex (1=M, 2=F) as arrays sorted by age in months, for vectorized lookup
+bmi_lookup_arrays = dict()
+for ( sex, lookup_table_sex ) in bmi_lookup_table.groupby( 'Sex' ):
+    order = numpy.argsort( lookup_table_sex['Agemos'].values, kind='mergesort' )
+    bmi_lookup_arrays[sex] = dict( [ ( column, lookup_table_sex[column].values[order] ) for column in [ 'Agemos', 'L', 'M', 'S' ] ] )
+
+    # The original per-record lookup sorted the table rows by their distance from the actual age (an unstable
+    # quicksort) and took the first row. Where the actual age lies exactly between two tabulated ages, that row is
+    # not always the younger one, so record the row the sort picks for the age between each pair of neighbours.
+    # For a missing age, all distances are missing and the sort keeps the first row of the table.
+    agemos = lookup_table_sex['Agemos'].values
+    midpoints = ( agemos[order][:-1] + agemos[order][1:] ) / 2
+    first_rows = [ numpy.argsort( numpy.abs( agemos - midpoint ), kind='quicksort' )[0] for midpoint in midpoints ]
+    bmi_lookup_arrays[sex]['tie_row'] = numpy.argsort( order )[first_rows]
+    bmi_lookup_arrays[sex]['missing_age_row'] = numpy.argsort( order )[0]
+
 #
-# Computation function
+# Computation function - BMI z-scores for arrays of BMI, age in years, and sex
 #
 
-def compute( record, demographics ):
-    X = record['bmi_value']
+def compute_zscores( bmi, age_years, sex ):
+    # REDCap is 0=F/1=M; table is 1=M/2=F
+    sex = numpy.where( sex == 0, 2, sex )
+    age_months = age_years * 12
+
+    z_scores = numpy.empty( len( bmi ) )
+    z_scores.fill( numpy.nan )
+    for ( lookup_sex, lookup_arrays ) in bmi_lookup_arrays.iteritems():
+        selected = ( sex == lookup_sex )
+        ages = age_months[selected]
+        missing_age = numpy.isnan( ages )
 
-    # Select the part of the lookup table for the correct sex (REDCap is 0=F/1=M; table is 1=M/2=F)
-    sex = demographics['sex'][record.name[0]]
-    if sex == 0:
-        sex = 2
-    lookup_table_sex = bmi_lookup_table[ bmi_lookup_table['Sex'] == sex ]
-    
-    # Sort lookup table rows by difference between actual and tabulated age, then take first row (closest age)
-    age_months = record['youthreport1_age'] * 12
-    lookup_table_sex['dAge'] = (lookup_table_sex['Agemos'] - age_months).map( abs )
-    lookup_row = lookup_table_sex.sort( columns = 'dAge', inplace = False ).irow(0)
+        # Find the tabulated age closest to the actual age, breaking ties the way the per-record sort did
+        agemos = lookup_arrays['Agemos']
+        upper = numpy.clip( numpy.searchsorted( agemos, ages ), 1, len( agemos )-1 )
+        lower = upper - 1
+        ( d_upper, d_lower ) = ( numpy.abs( agemos[upper] - ages ), numpy.abs( agemos[lower] - ages ) )
+        closest = numpy.where( d_upper < d_lower, upper, lower )
+        closest = numpy.where( d_upper == d_lower, lookup_arrays['tie_row'][lower], closest )
+        closest = numpy.where( missing_age, lookup_arrays['missing_age_row'], closest )
 
-    (L,M,S) = (lookup_row['L'],lookup_row['M'],lookup_row['S'])
+        (L,M,S) = (lookup_arrays['L'][closest],lookup_arrays['M'][closest],lookup_arrays['S'][closest])
+        z_scores[selected] = ( numpy.power( bmi[selected]/M, L ) - 1 ) / (L*S)
 
-    z_score = ( pow(X/M,L) - 1) / (L*S)
-    return z_score
+    return z_scores
 
 #
 # Driver function - go through the steps of status determination
 #
 def compute_scores( data, demographics ):
     # Get rid of all records that don't have YR1
-    data.dropna( axis=1, subset=['youth_report_1_complete'] )
     data = data[ data['youth_report_1_complete'] > 0 ]
     data = data[ ~(data['youthreport1_missing'] > 0) ]
 
@@ -75,9 +97,10 @@ def compute_scores( data, demographics ):
     data['bmi_value'] = data['youthreport1_cddrweight'] / ( data['youthreport1_cddrheight'] * data['youthreport1_cddrheight'] )
 
     # Do computations, return result
-    data['bmi_zscore'] = data.apply( compute, axis=1, demographics=demographics )
+    sex = demographics['sex'].reindex( data.index.get_level_values( 0 ) ).values
+    data['bmi_zscore'] = compute_zscores( data['bmi_value'].values.astype( float ), data['youthreport1_age'].values.astype( float ), sex )
 
     from scipy.stats import norm
-    data['bmi_percentile'] = data['bmi_zscore'].map( norm.cdf ) * 100
+    data['bmi_percentile'] = norm.cdf( data['bmi_zscore'].values ) * 100
 
     return data[outfield_list]
@@ -9,6 +9,7 @@ import os
 import time
 import datetime
 
+import numpy
 import pandas
 
 #
@@ -45,6 +46,59 @@ lookup_global = pandas.io.parsers.read_csv( os.path.join( module_dir, 'BRIEF_loo
 lookup_subscales = pandas.io.parsers.read_csv( os.path.join( module_dir, 'BRIEF_lookup_subscales.csv' ), header=0, index_col=[0,1,2] )
 lookup_index = pandas.io.parsers.read_csv( os.path.join( module_dir, 'BRIEF_lookup_index.csv' ), header=0, index_col=[0,1,2] )
 
+# Age groups and sexes of the lookup tables, in the order of the lookup array axes
+lookup_ages = [ 14, 15 ]
+lookup_sexes = [ 'F', 'M' ]
+
+# Turn a lookup table into dense arrays indexed by [age group, sex, raw score] - one array per score column,
+# plus a mask of the (age, sex, raw) keys that exist in the table
+def make_lookup_arrays( lookup_table ):
+    age_idx = numpy.array( [ lookup_ages.index( age ) for age in lookup_table.index.get_level_values( 0 ) ] )
+    sex_idx = numpy.array( [ lookup_sexes.index( sex ) for sex in lookup_table.index.get_level_values( 1 ) ] )
+    raw_idx = numpy.array( lookup_table.index.get_level_values( 2 ), dtype=int )
+
+    defined = numpy.zeros( ( len( lookup_ages ), len( lookup_sexes ), raw_idx.max()+1 ), dtype=bool )
+    defined[ age_idx, sex_idx, raw_idx ] = True
+
+    arrays = dict()
+    for column in lookup_table.columns:
+        arrays[column] = numpy.empty( defined.shape )
+        arrays[column].fill( numpy.nan )
+        arrays[column][ age_idx, sex_idx, raw_idx ] = lookup_table[column].values
+
+    return ( defined, arrays )
+
+lookup_global_arrays = make_lookup_arrays( lookup_global )
+lookup_subscales_arrays = make_lookup_arrays( lookup_subscales )
+lookup_index_arrays = make_lookup_arrays( lookup_index )
+
+# Look up a score column for arrays of age group, sex, and raw score indexes. Like the table lookup, this fails
+# for keys that are not in the table. Columns without missing values are returned as integers, as they were
+# when looked up record by record.
+def lookup_scores( lookup_arrays, column, age_idx, sex_idx, raw ):
+    ( defined, arrays ) = lookup_arrays
+    raw_idx = numpy.array( raw, dtype=int )
+    in_table = ( raw_idx >= 0 ) & ( raw_idx < defined.shape[2] )
+    in_table[in_table] = defined[ age_idx[in_table], sex_idx[in_table], raw_idx[in_table] ]
+    if not in_table.all():
+        missing = numpy.nonzero( ~in_table )[0][0]
+        raise KeyError( ( lookup_ages[age_idx[missing]], lookup_sexes[sex_idx[missing]], raw[missing] ) )
+
+    scores = arrays[column][ age_idx, sex_idx, raw_idx ]
+    if not numpy.isnan( scores ).any():
+        scores = scores.astype( int )
+    return scores
+
+# Expand scores looked up for the selected records to all records, leaving the others blank
+def expand_scores( scores, selected ):
+    if selected.all():
+        return scores
+
+    all_scores = numpy.empty( len( selected ) )
+    all_scores.fill( numpy.nan )
+    all_scores[selected] = scores
+    return all_scores
+
 # From the BRIEF VBA script - indexes the questions to the subscales
 question_to_subscales = {   1: 1, 2: 3, 3: 6, 4: 7, 5: 4, 6: 8, 7: 5, 8: 9, 9: 2, 
                            10: 1, 11: 3, 12: 6, 13: 7, 14: 4, 15: 8, 16: 5, 17: 9, 18: 2, 19: 1, 
@@ -85,48 +139,38 @@ def compute_scores( data, demographics ):
 
     # What is each subject's age at test?
     date_format_ymd = '%Y-%m-%d'
-    data['brief_age'] = 0.0
-    for key, row in data.iterrows():
-        dob = demographics['dob'][key[0]]
-        data['brief_age'][key] = (datetime.datetime.strptime( row['youthreport2_date_interview'], date_format_ymd ) - datetime.datetime.strptime( dob, date_format_ymd )).days / 365.242
+    subjects = data.index.get_level_values( 0 )
+    dob = pandas.to_datetime( demographics['dob'].reindex( subjects ).values, format=date_format_ymd ).values
+    date_interview = pandas.to_datetime( data['youthreport2_date_interview'].values, format=date_format_ymd ).values
+    data['brief_age'] = ( ( date_interview - dob ) / numpy.timedelta64( 1, 'D' ) ) / 365.242
 
     # Compute negativity
     data['brief_neg'] = 0
     for idx in range(1,11):
         # Have to count "2"s, because our scale is 0..2, whereas original implementation used scale 1..3
-        data['brief_neg'] = data['brief_neg'] + data[ input_fields['youthreport2'][negativity_questions[idx-1]-1] ].map( lambda x: 1 if x==2 else 0 )
+        data['brief_neg'] = data['brief_neg'] + (data[ input_fields['youthreport2'][negativity_questions[idx-1]-1] ] == 2).astype( int )
         
     # Compute inconsistency
     data['brief_incon'] = 0
     for idx in range(1,11):
         data['brief_incon'] = data['brief_incon'] + (data[ input_fields['youthreport2'][inconsistency_questions[idx-1][0]-1] ] - data[ input_fields['youthreport2'][inconsistency_questions[idx-1][1]-1] ]).abs()
 
-    # Lookup from subscale
-    for idx in range(1,11):
-        data[ labels[idx]+'_t' ] = 0
-        data[ labels[idx]+'_p' ] = 0
-        for key, row in data.iterrows():
-            sex = demographics['sex'][key[0]]
-            lookup_key = ( 14 if row['brief_age'] < 15 else 15, 'F' if sex == 0 else 'M', row[ labels[idx]+'_raw' ] )
-            data[ labels[idx]+'_t' ][key] = lookup_subscales[labels[idx]+'_t'][lookup_key]      
-            data[ labels[idx]+'_p' ][key] = lookup_subscales[labels[idx]+'_p'][lookup_key]      
-
-    for idx in range(11,13):
-        data[ labels[idx]+'_t' ] = 0
-        data[ labels[idx]+'_p' ] = 0
-        for key, row in data.iterrows():
-            sex = demographics['sex'][key[0]]
-            lookup_key = ( 14 if row['brief_age'] < 15 else 15, 'F' if sex == 0 else 'M', row[ labels[idx]+'_raw' ] )
-            data[ labels[idx]+'_t' ][key] = lookup_index[labels[idx]+'_t'][lookup_key]      
-            data[ labels[idx]+'_p' ][key] = lookup_index[labels[idx]+'_p'][lookup_key]      
-
-    data[ labels[13]+'_t' ] = 0
-    data[ labels[13]+'_p' ] = 0
-    for key, row in data.iterrows():
-        sex = demographics['sex'][key[0]]
-        lookup_key = ( 14 if row['brief_age'] < 15 else 15, 'F' if sex == 0 else 'M', row[ labels[13]+'_raw' ] )
-        data[ labels[13]+'_t' ][key] = lookup_global[labels[13]+'_t'][lookup_key]      
-        data[ labels[13]+'_p' ][key] = lookup_global[labels[13]+'_p'][lookup_key]      
+    # Norms depend on age and sex - records of subjects with unknown age (missing birth or interview date) or
+    # sex are not normed, i.e., their T scores and percentiles are left blank
+    age = data['brief_age'].values
+    sex = demographics['sex'].reindex( subjects ).values
+    normed = ~numpy.isnan( age ) & ~pandas.isnull( sex )
+
+    # Lookup array indexes for age group (14 if under 15, else 15) and sex (0 is female)
+    age_idx = ( ~( age[normed] < 15 ) ).astype( int )
+    sex_idx = ( sex[normed] != 0 ).astype( int )
+
+    # Lookup from subscales, indexes, and global scale
+    for ( first, last, lookup_arrays ) in [ ( 1, 10, lookup_subscales_arrays ), ( 11, 12, lookup_index_arrays ), ( 13, 13, lookup_global_arrays ) ]:
+        for idx in range( first, last+1 ):
+            raw = data[ labels[idx]+'_raw' ].values[normed]
+            for score in [ '_t', '_p' ]:
+                data[ labels[idx]+score ] = expand_scores( lookup_scores( lookup_arrays, labels[idx]+score, age_idx, sex_idx, raw ), normed )
 
     data['brief_complete'] = '1'
 
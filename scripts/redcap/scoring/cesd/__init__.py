@@ -40,7 +40,6 @@ R2rc = { 'CES Symptomatology Score' : 'cesd_score' }
 #
 def compute_scores( data, demographics ):
     # Get rid of all records that don't have MRI Report
-    data.dropna( axis=1, subset=['mri_report_complete'] )
     data = data[ data['mri_report_complete'] > 0 ]
     data = data[ ~(data['mrireport_missing'] > 0) ]
 
@@ -52,7 +51,7 @@ def compute_scores( data, demographics ):
     data.columns = Rwrapper.map_labels( data.columns, rc2lime )
 
     # Call the scoring function for all table rows
-    scores = data.apply( Rwrapper.runscript, axis=1, Rscript='cesd/CES_D.R', scores_key='CES.ary' )
+    scores = Rwrapper.runscript_batch( data, Rscript='cesd/CES_D.R', scores_key='CES.ary' )
 
     # Replace all score columns with REDCap field names
     scores.columns = Rwrapper.map_labels( scores.columns, R2rc )
@@ -46,7 +46,6 @@ R2rc = { 'Emotional Abuse Scale Total Score' : 'ctq_ea',
 #
 def compute_scores( data, demographics ):
     # Get rid of all records that don't have YR2
-    data.dropna( axis=1, subset=['youth_report_2_complete'] )
     data = data[ data['youth_report_2_complete'] > 0 ]
     data = data[ ~(data['youthreport2_missing'] > 0) ]
 
@@ -58,7 +57,7 @@ def compute_scores( data, demographics ):
     data.columns = Rwrapper.map_labels( data.columns, rc2lime )
 
     # Call the scoring function for all table rows
-    scores = data.apply( Rwrapper.runscript, axis=1, Rscript='ctq/CTQ.R', scores_key='CTQ.ary' )
+    scores = Rwrapper.runscript_batch( data, Rscript='ctq/CTQ.R', scores_key='CTQ.ary' )
 
     # Replace all score columns with REDCap field names
     scores.columns = Rwrapper.map_labels( scores.columns, R2rc )
@@ -40,7 +40,6 @@ R2rc = { 'DRHQ.TMV' : 'drhq_tmv', 'DRHQ.DSS' : 'drhq_dss', 'DRHQ.DUI' : 'drhq_du
 #
 def compute_scores( data, demographics ):
     # Get rid of all records that don't have YR2
-    data.dropna( axis=1, subset=['youth_report_2_complete'] )
     data = data[ data['youth_report_2_complete'] > 0 ]
     data = data[ ~(data['youthreport2_missing'] > 0) ]
 
@@ -52,7 +51,7 @@ def compute_scores( data, demographics ):
     data.columns = RwrapperNew.map_labels( data.columns, rc2lime )
 
     # Call the scoring function for all table rows
-    scores = data.apply( RwrapperNew.runscript, axis=1, Rscript='drhq/DRHQ.R' )
+    scores = RwrapperNew.runscript_batch( data, Rscript='drhq/DRHQ.R' )
 
     # Replace all score columns with REDCap field names
     scores.columns = RwrapperNew.map_labels( scores.columns, R2rc )
@@ -116,13 +116,49 @@ def compute( record ):
     return record[ outfield_list ]
 
 #
-# Driver function - go through the steps of status determination
+# Count relatives from count fields and "yes" fields, the same way as "compute" - note that
+# "yes" fields are compared to the string '1'
+#
+def count_relatives( data, count_fields, yes_fields ):
+    count = numpy.zeros( len( data ) )
+    for f in count_fields:
+        count = count + numpy.array( data[f].map( safe_float ), dtype=float )
+    for f in yes_fields:
+        count = count + ( data[f].values.astype( object ) == '1' )
+    return count
+
+#
+# Driver function - go through the steps of status determination for all records at once.
+# Results are the same as applying "compute" to each record; like "compute", this does not
+# check the "missing" flags.
 #
 def compute_scores( data, demographics ):
-    for f in outfield_list:
-        data[f] = ''
+    # If no records to score, return empty DF
+    if len( data ) == 0:
+        return pandas.DataFrame()
+
+    have_youth = ( data['youth_report_1_complete'] > 0 ).values
+    first_degree = count_relatives( data, [ 'youthreport1_yfhi3b_yfhi3k_1', 'youthreport1_yfhi3b_yfhi3l_1' ], [ 'youthreport1_yfhi3a_yfhi3a', 'youthreport1_yfhi3a_yfhi3f' ] )
+    second_degree = count_relatives( data, [ 'youthreport1_yfhi3b_yfhi3d_1', 'youthreport1_yfhi3b_yfhi3e_1', 'youthreport1_yfhi3b_yfhi3i_1', 'youthreport1_yfhi3b_yfhi3j_1' ], [ 'youthreport1_yfhi3a_yfhi3b', 'youthreport1_yfhi3a_yfhi3c', 'youthreport1_yfhi3a_yfhi3g', 'youthreport1_yfhi3a_yfhi3h' ] )
+
+    have_parent = ( data['parent_report_complete'] > 0 ).values
+    first_degree_pr = count_relatives( data, [ 'parentreport_pfhi3b_pfhi3k_1', 'parentreport_pfhi3b_pfhi3l_1' ], [ 'parentreport_pfhi3a_pfhi3a', 'parentreport_pfhi3a_pfhi3f' ] )
+    second_degree_pr = count_relatives( data, [ 'parentreport_pfhi3b_pfhi3d_1', 'parentreport_pfhi3b_pfhi3e_1', 'parentreport_pfhi3b_pfhi3i_1', 'parentreport_pfhi3b_pfhi3j_1' ], [ 'parentreport_pfhi3a_pfhi3b', 'parentreport_pfhi3a_pfhi3c', 'parentreport_pfhi3a_pfhi3g', 'parentreport_pfhi3a_pfhi3h' ] )
+
+    # Check against youth-reported relatives; use higher number
+    first_degree = numpy.where( have_parent & ( ~have_youth | ( first_degree_pr > first_degree ) ), first_degree_pr, first_degree )
+    second_degree = numpy.where( have_parent & ( ~have_youth | ( second_degree_pr > second_degree ) ), second_degree_pr, second_degree )
+
+    # Completion status is copied from youth report, or parent report if there is no youth report
+    complete = numpy.where( have_youth, data['youth_report_1_complete'].map( str ).values,
+                            numpy.where( have_parent, data['parent_report_complete'].map( str ).values, '' ) )
+
+    # Make classification based on maximum of youth/parent reported relative counts
+    scored = have_youth | have_parent
+    results = pandas.DataFrame( index=data.index )
+    results['fh_alc'] = numpy.where( scored, numpy.where( ( first_degree >= 1 ) | ( second_degree >= 2 ), 'P', 'N' ), '' ).astype( object )
+    results['fh_alc_density'] = numpy.where( scored, ( first_degree + 0.5 * second_degree ).astype( object ), '' )
+    results['fh_alc_complete'] = complete.astype( object )
 
-    # Do computations, return result
-    results = data.apply( compute, axis=1 )
     results.index = pandas.MultiIndex.from_tuples( results.index )
-    return results
+    return results[ outfield_list ]
@@ -248,68 +248,154 @@ def compute_status( row ):
     return status
 
 #
-# Driver function - go through the steps of status determination
+# Vectorized versions of the per-record functions above - each computes one variable for all records at once
+#
+
+# Records for which a report is complete and not marked missing
+def have_report( data, complete_field, missing_field ):
+    return ( ( data[complete_field] > 0 ) & ~( data[missing_field] > 0 ) ).values
+
+# Records for which any of the given fields is equal to the given value
+def any_equal( data, fields, value ):
+    result = numpy.zeros( len( data ), dtype=bool )
+    for field in fields:
+        result = result | ( data[field] == value ).values
+    return result
+
+# Minimum of several columns with the semantics of Python's "min", which "compute_extern" uses: a later value
+# only replaces the current minimum if it compares smaller, so a missing first value makes the result missing
+def min_as_python( data, fields ):
+    result = data[fields[0]].values.astype( float )
+    for field in fields[1:]:
+        values = data[field].values.astype( float )
+        result = numpy.where( values < result, values, result )
+    return result
+
+# Count relatives with a "yes" answer in youth or parent report - "field_pairs" are (youth fields, parent fields)
+def count_relatives( data, field_pairs ):
+    have_youth_report = have_report( data, 'youth_report_1_complete', 'youthreport1_missing' )
+    have_parent_report = have_report( data, 'parent_report_complete', 'parentreport_missing' )
+
+    count = numpy.zeros( len( data ) )
+    for ( youth_fields, parent_fields ) in field_pairs:
+        count = count + ( ( have_youth_report & any_equal( data, youth_fields, 1 ) ) | ( have_parent_report & any_equal( data, parent_fields, 1 ) ) )
+    return numpy.where( have_youth_report | have_parent_report, count, numpy.nan )
+
+# Same as "compute_parhx" (including its check of 'parentreport_pfhi3a_pfhi3a' for the mother)
+def compute_parhx_all( data ):
+    return count_relatives( data, [ ( [ 'youthreport1_yfhi3a_yfhi3a', 'youthreport1_yfhi4a_yfhi4a' ], [ 'parentreport_pfhi3a_pfhi3a', 'parentreport_pfhi4a_pfhi4a' ] ),
+                                    ( [ 'youthreport1_yfhi3a_yfhi3f', 'youthreport1_yfhi4a_yfhi4f' ], [ 'parentreport_pfhi3a_pfhi3a', 'parentreport_pfhi4a_pfhi4f' ] ) ] )
+
+# Same as "compute_gparhx"
+def compute_gparhx_all( data ):
+    return count_relatives( data, [ ( [ 'youthreport1_yfhi3a_yfhi3%s' % rel, 'youthreport1_yfhi4a_yfhi4%s' % rel ], [ 'parentreport_pfhi3a_pfhi3%s' % rel, 'parentreport_pfhi4a_pfhi4%s' % rel ] )
+                                    for rel in [ 'b', 'c', 'g', 'h' ] ] )
+
+# Conditions counted by "compute_extern": ( variable, comparison, value, age of onset variables )
+extern_conditions = [ ( 'as2a', '==', 5, [ 'asa_ao2', 'asa_ao2dk' ] ),
+                      ( 'as2b', '==', 5, [ 'asb_ao2', 'asb_ao2dk' ] ),
+                      ( 'as6b', '>', 1, [ 'asc1_ao6', 'asc2_ao6', 'asc1_ao6dk', 'asc2_ao6dk' ] ),
+                      ( 'as9', '==', 5, [ 'as_ao9', 'as_ao9dk' ] ),
+                      ( 'as10a', '>', 1, [ 'as_ao10', 'as_ao10dk' ] ),
+                      ( 'as11', '>', 1, [ 'as1_ao11', 'as2_ao11', 'as1_ao11dk', 'as2_ao11dk' ] ),
+                      ( 'as15', '>', 1, [ 'as1_ao15', 'as2_ao15', 'as1_ao15dk', 'as2_ao15dk' ] ),
+                      ( 'as16', '>', 1, [ 'as1_ao16', 'as2_ao16', 'as1_ao16dk', 'as2_ao16dk' ] ),
+                      ( 'as17a', '==', 5, [ 'as1_ao17', 'as2_ao17', 'as1_ao17dk', 'as2_ao17dk' ] ),
+                      ( 'as19', '>', 1, [ 'as1_ao19', 'as2_ao19', 'as1_ao19dk', 'as2_ao19dk' ] ),
+                      ( 'as18b', '==', 5, [ 'as1_ao18', 'as2_ao18', 'as1_ao18dk', 'as2_ao18dk' ] ),
+                      ( 'as20', '>', 1, [ 'as1_ao20', 'as2_ao20', 'as1_ao20dk', 'as2_ao20dk' ] ) ]
+
+# Same as "compute_extern"
+def compute_extern_all( data, ssaga ):
+    def field( var ):
+        return 'ssaga_%s_%s' % (ssaga,var)
+
+    def condition( var, comparison, value, onset_vars ):
+        if comparison == '==':
+            answered = ( data[field( var )] == value ).values
+        else:
+            answered = ( data[field( var )] > value ).values
+        return answered & ( min_as_python( data, [ field( v ) for v in onset_vars ] ) < age_onset )
+
+    age_onset = data[field( 'al1ageons' )].values.astype( float )
+
+    extern = numpy.zeros( len( data ) )
+    for ( var, comparison, value, onset_vars ) in extern_conditions:
+        extern = extern + condition( var, comparison, value, onset_vars )
+
+    # The "as14" check is an "and" of two conditions
+    extern = extern + ( condition( 'as14', '>', 1, [ 'asa1_ao14', 'asa2_ao14', 'asa1_ao14dk', 'asa2_ao14dk' ] ) &
+                        condition( 'as14b', '>', 1, [ 'asc1_ao14', 'asc2_ao14', 'asc1_ao14dk', 'asc2_ao14dk' ] ) )
+
+    return numpy.where( have_report( data, field( 'complete' ), field( 'missing' ) ), extern, numpy.nan )
+
+# Same as "compute_intern" on the records prepared by the previous per-record driver, which left 'dp15d' empty
+# for every scored SSAGA (its age recoding loop writes to the last variable in "ssaga_variables" instead of
+# the variables it lists) - so 'dp15d' never counts here either
+def compute_intern_all( data, ssaga ):
+    def field( var ):
+        return 'ssaga_%s_%s' % (ssaga,var)
+
+    def equal( var, value ):
+        return ( data[field( var )] == value ).values
+
+    age_onset = data[field( 'al1ageons' )].values.astype( float )
+
+    intern = numpy.zeros( len( data ) )
+    intern = intern + ( equal( 'oc1', 5 ) & ( data[field( 'oc_ao8' )].values < age_onset ) )
+    intern = intern + ( equal( 'oc9', 5 ) & ( data[field( 'oc_ao16' )].values < age_onset ) )
+
+    pn_age_check = ( data[field( 'pn_ao8' )].values < age_onset ) | ( equal( 'pn_ao8dk', 1 ) & ( age_onset > 10 ) ) | ( equal( 'pn_ao8dk', 2 ) & ( age_onset > 20 ) )
+    intern = intern + ( ( equal( 'pn1x', 5 ) | equal( 'pn2a', 5 ) | equal( 'pn2b', 5 ) | ( data[field( 'pn5' )] > 2 ).values ) & pn_age_check )
+
+    dp3_age_check = ( data[field( 'dp3' )].values < age_onset ) | ( equal( 'dp3_1', 1 ) & ( age_onset > 10 ) ) | ( equal( 'dp3_1', 2 ) & ( age_onset > 20 ) )
+    intern = intern + ( ( equal( 'dp4a', 5 ) | equal( 'dp4b', 5 ) ) & dp3_age_check )
+    intern = intern + ( ( equal( 'dp11', 5 ) | equal( 'dp12', 5 ) ) & dp3_age_check )
+    intern = intern + ( ( equal( 'dp15a', 5 ) | equal( 'dp15b', 5 ) | equal( 'dp15c', 5 ) ) & dp3_age_check )
+
+    return numpy.where( have_report( data, field( 'complete' ), field( 'missing' ) ), intern, numpy.nan )
+
+# Same as "compute_status" - note that a missing SSAGA completion status counts as complete here
+def compute_status_all( data ):
+    status = ( data['highrisk_gparhx'] > 1 ).values | ( data['highrisk_parhx'] > 1 ).values
+    for ssaga in [ 'youth', 'parent' ]:
+        status = status | ( ( data['ssaga_%s_complete' % ssaga] != 0 ).values & ~( data['ssaga_%s_missing' % ssaga] > 0 ).values & ( data['ssaga_%s_al1ageons' % ssaga] <= 14 ).values )
+    status = status | ( data['highrisk_yss_intern'] > 2 ).values | ( data['highrisk_pss_intern'] > 2 ).values
+    status = status | ( data['highrisk_yss_extern'] > 2 ).values | ( data['highrisk_pss_extern'] > 2 ).values
+    return status.astype( int )
+
+#
+# Driver function - go through the steps of status determination for all records at once.
+# Results are the same as those of the previous per-record driver, which recoded SSAGA ages and applied the
+# per-record functions above row by row.
 #
 def compute_scores( data, demographics ):
     outfield_list = [ 'highrisk_parhx', 'highrisk_gparhx', 
                       'highrisk_yss_intern', 'highrisk_yss_extern', 'highrisk_yss_al1ageons', 
                       'highrisk_pss_intern', 'highrisk_pss_extern', 'highrisk_pss_al1ageons', 
                       'highrisk_status', 'highrisk_complete' ]
-    for outfield in outfield_list:
-        data[outfield] = 0
-
-    # First, for each SSAGA (Youth and Parent) determine subject age and re-code age-related fields according to lookup table
-    date_format_ymd = '%Y-%m-%d'
-    for key, row in data.iterrows():
-        try:
-            dob = datetime.datetime.strptime( demographics['dob'][key[0]], date_format_ymd )
-            for ssaga in ['youth','parent']:
-                if (row['ssaga_%s_complete' % ssaga] > 0) and not (row['ssaga_%s_missing' % ssaga] > 0):
-                    try:
-                        age = (datetime.datetime.strptime( row['ssaga_%s_dotest' % ssaga], date_format_ymd ) - dob).days / 365.242
-                    except:
-                        #Old Printing method
-                        #print 'WARNING: Problem parsing',ssaga,'SSAGA date',row['ssaga_%s_dotest' % ssaga],'for subject',key[0],row['ssaga_%s_record_id'%ssaga]
-                        error = dict(subject_id=key[0],
-                                 ssage=ssage,
-                                 ssaga_date=row['ssaga_%s_dotest' % ssaga],
-                                 error='WARNING: Problem parsing.')
-                        print(json.dumps(error, sort_keys=True))
-                    age = numpy.nan
-                    for column in ssaga_recode_as_age:
-                        fieldname = 'ssaga_%s_%s' % (ssaga,var)
-                        data[fieldname][key] = recode_field_as_age( data[fieldname][key], age )
-        except:
-            #Old Printing Method
-            #print 'WARNING: Problem determining DOB for subject',key[0]
-            error = dict(subject_id = key[0],
-                         error = 'WARNING: Problem determining DOB for subject')
-            for column in ssaga_recode_as_age:
-                for ssaga in ['youth','parent']:
-                    fieldname = 'ssaga_%s_%s' % (ssaga,var)
-                    data[fieldname][key] = numpy.nan
-
-    # Second, compute "parhx" and "gparhx" from youth and/or parent repor
-    data['highrisk_parhx'] = data.apply( compute_parhx, axis=1 )
-    data['highrisk_gparhx'] = data.apply( compute_gparhx, axis=1 )
-
-    # Third, compute "internalizing" from Youth and/or Parent SSAGA
-    data['highrisk_yss_intern'] = data.apply( compute_intern_youth, axis=1 )
-    data['highrisk_pss_intern'] = data.apply( compute_intern_parent, axis=1 )
-
-    # Fourth, compute "exterrnalizing" from Youth and/or Parent SSAGA
-    data['highrisk_yss_extern'] = data.apply( compute_extern_youth, axis=1 )
-    data['highrisk_pss_extern'] = data.apply( compute_extern_parent, axis=1 )    
-
-    # Fifth, compute composite "risk status"
-    data['highrisk_status'] = data.apply( compute_status, axis=1 )
-
-    # Sixth, for good measure, copy the "Age of Onset" columns from the two SSAGA instruments
+
+    # First, compute "parhx" and "gparhx" from youth and/or parent report
+    data['highrisk_parhx'] = compute_parhx_all( data )
+    data['highrisk_gparhx'] = compute_gparhx_all( data )
+
+    # Second, compute "internalizing" from Youth and/or Parent SSAGA
+    data['highrisk_yss_intern'] = compute_intern_all( data, 'youth' )
+    data['highrisk_pss_intern'] = compute_intern_all( data, 'parent' )
+
+    # Third, compute "exterrnalizing" from Youth and/or Parent SSAGA
+    data['highrisk_yss_extern'] = compute_extern_all( data, 'youth' )
+    data['highrisk_pss_extern'] = compute_extern_all( data, 'parent' )
+
+    # Fourth, compute composite "risk status"
+    data['highrisk_status'] = compute_status_all( data )
+
+    # Fifth, for good measure, copy the "Age of Onset" columns from the two SSAGA instruments
     data['highrisk_yss_al1ageons'] = data['ssaga_youth_al1ageons']
     data['highrisk_pss_al1ageons'] = data['ssaga_parent_al1ageons']
 
     # Finally, convert everything to strings (and nan to emptry string) to avoid validation errors
-    for outfield in outfield_list:
+    for outfield in outfield_list[:-1]:
         data[outfield] = data[outfield].map( lambda x: str(int(x)) if str(x) != 'nan' else '' )
 
     data['highrisk_complete'] = '1'
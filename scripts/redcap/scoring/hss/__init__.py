@@ -42,7 +42,6 @@ R2rc = { 'HSS Past Week Score' : 'hss_pastweek', 'HSS Past Year Score' : 'hss_pa
 #
 def compute_scores( data, demographics ):
     # Get rid of all records that don't have MRI Report
-    data.dropna( axis=1, subset=['youth_report_2_complete'] )
     data = data[ data['youth_report_2_complete'] > 0 ]
     data = data[ ~(data['youthreport2_missing'] > 0) ]
 
@@ -54,7 +53,7 @@ def compute_scores( data, demographics ):
     data.columns = Rwrapper.map_labels( data.columns, rc2lime )
 
     # Call the scoring function for all table rows
-    scores = data.apply( Rwrapper.runscript, axis=1, Rscript='hss/HSS.R', scores_key='HSS.ary' )
+    scores = Rwrapper.runscript_batch( data, Rscript='hss/HSS.R', scores_key='HSS.ary' )
 
     # Replace all score columns with REDCap field names
     scores.columns = Rwrapper.map_labels( scores.columns, R2rc )
@@ -21,7 +21,6 @@ output_form = 'clinical'
 #
 def compute_scores( data, demographics ):
     # Get rid of all records that don't have MRI Report
-    data.dropna( axis=1, subset=['mri_report_complete'] )
     data = data[ data['mri_report_complete'] > 0 ]
     data = data[ ~(data['mrireport_missing'] > 0) ]
 
@@ -25,7 +25,6 @@ output_form = 'clinical'
 #
 def compute_scores( data, demographics ):
     # Get rid of all records that don't have YR2
-    data.dropna( axis=1, subset=['youth_report_2_complete'] )
     data = data[ data['youth_report_2_complete'] > 0 ]
 
     data['upps_nug'] = (5-data['youthreport2_upps_sec2_upps17']+5-data['youthreport2_upps_sec2_upps22']+data['youthreport2_upps_sec3_upps29']+data['youthreport2_upps_sec3_upps34'])/4     # Negative Urgency
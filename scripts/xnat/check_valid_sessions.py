@@ -65,9 +65,8 @@ def main(args=None):
                                   args.experimentsdir, args.num_extract)
 
     # extract info from the experiment XML files
-    experiment = xe.get_experiments_dir_info(args.experimentsdir)
-    scan = xe.get_experiments_dir_scan_info(args.experimentsdir)
-    reading = xe.get_experiments_dir_reading_info(args.experimentsdir)
+    experiment, scan, reading = \
+        xe.get_experiments_dir_all_info(args.experimentsdir)
     df = xe.merge_experiments_scans_reading(experiment, scan, reading)
 
     # exclude phantoms, including the traveling human phantoms
@@ -141,10 +141,8 @@ def main(args=None):
                                   args.experimentsdir, args.num_extract)
 
     # extract info from the experiment XML files
-    experiment = xe.get_experiments_dir_info(args.experimentsdir)
-    experiment_df = xe.experiments_to_dataframe(experiment)
-    reading = xe.get_experiments_dir_reading_info(args.experimentsdir)
-    reading_df = xe.reading_to_dataframe(reading)
+    experiment_df, scan_df, reading_df = \
+        xe.get_experiments_dir_all_info(args.experimentsdir)
     experiment_reading = inner_join_dataframes(experiment_df, reading_df)
 
     # exclude phantoms, but include the traveling human phantoms
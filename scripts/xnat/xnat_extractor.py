@@ -14,7 +14,12 @@ __modified__ = "2015-08-26"
 import os
 import glob
 import json
+import hashlib
 import tempfile
+import threading
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
 
 import requests
 import pandas as pd
@@ -26,9 +31,33 @@ verbose = None
 # Define global namespace for parsing XNAT XML files
 ns = {'xnat': 'http://nrg.wustl.edu/xnat'}
 
+# Fully qualified tags of the elements read by the streaming parser
+xnat_tags = dict([(tag, '{%s}%s' % (ns['xnat'], tag))
+                  for tag in ['date', 'subject_ID', 'note', 'scans', 'scan',
+                              'quality', 'series_description', 'coil',
+                              'fieldStrength', 'fields', 'field']])
+
+# Columns of the reading records that exist even if a session has no such
+# field
+reading_columns = ['experiment_id', 'note', 'datetodvd', 'findings',
+                   'findingsdate', 'excludefromanalysis',
+                   'physioproblemoverride', 'dtimismatchoverride',
+                   'phantommissingoverride']
+
 # Define global format to be used in XNAT requests
 return_format = '?format=csv'
 
+# Number of experiment XML files downloaded in parallel
+default_jobs = 8
+
+# Number of processes parsing experiment XML files in parallel
+default_parse_jobs = multiprocessing.cpu_count()
+
+# File in the experiments directory that keeps the ETag, Last-Modified header,
+# and checksum of each downloaded experiment (hidden, so that it is not listed
+# with the experiment files)
+download_state_filename = '.download_state.json'
+
 
 def get_config(config_file):
     """
@@ -112,43 +141,165 @@ def write_experiments(config, session):
     return experiments_filename
 
 
-def extract_experiment_xml(config, session, experiment_dir, extract=None):
+def read_download_state(outdir):
+    """
+    Read the download state of an experiments directory
+
+    :param outdir: str
+    :return: dict of experiment id -> dict
+    """
+    try:
+        with open(os.path.join(outdir, download_state_filename), 'r') as fi:
+            return json.load(fi)
+    except (IOError, ValueError):
+        return dict()
+
+
+def write_file_atomic(filename, content):
+    """
+    Write a file by writing a temporary (hidden) file in the same directory and
+    renaming it in place, so readers never see a partial file
+
+    :param filename: str
+    :param content: str
+    :return: None
+    """
+    (fd, tmp_filename) = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                          prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as fi:
+            fi.write(content)
+        os.rename(tmp_filename, filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+class ExperimentDownloader(object):
+    """
+    Downloads experiment XML files with one keep-alive session per thread,
+    skipping experiments that have not changed since the last download
+    """
+    def __init__(self, config, session, outdir, state):
+        self.entities = get_entities(config)
+        self.session = session
+        self.outdir = outdir
+        self.state = state
+        self.local = threading.local()
+
+    def get_session(self):
+        # requests sessions are not thread-safe - each thread gets its own,
+        # logged in with the cookies (JSESSIONID) of the given session
+        if not hasattr(self.local, 'session'):
+            session = requests.session()
+            session.auth = self.session.auth
+            session.cookies.update(self.session.cookies)
+            self.local.session = session
+        return self.local.session
+
+    def download(self, experiment_id):
+        """
+        Download one experiment XML file unless it is unchanged
+
+        :param experiment_id: str
+        :return: tuple (experiment_id, file name or None on error,
+                        state, whether the file was written)
+        """
+        experiment_file = os.path.join(self.outdir,
+                                       '{0}.xml'.format(experiment_id))
+        previous = self.state.get(experiment_id, dict())
+        headers = dict()
+        if os.path.exists(experiment_file):
+            if previous.get('etag'):
+                headers['If-None-Match'] = previous['etag']
+            if previous.get('last_modified'):
+                headers['If-Modified-Since'] = previous['last_modified']
+
+        url = self.entities.get('experiment')(experiment_id) + return_format
+        try:
+            experiment = self.get_session().get(url, headers=headers)
+        except requests.exceptions.RequestException, e:
+            print("Error downloading experiment {0}: {1}".format(experiment_id, e))
+            return (experiment_id, None, None, False)
+
+        if experiment.status_code == 304:
+            return (experiment_id, experiment_file, previous, False)
+        if experiment.status_code != 200:
+            print("Error downloading experiment {0}: HTTP status {1}".format(experiment_id, experiment.status_code))
+            return (experiment_id, None, None, False)
+
+        checksum = hashlib.sha1(experiment.content).hexdigest()
+        new_state = dict(etag=experiment.headers.get('ETag'),
+                         last_modified=experiment.headers.get('Last-Modified'),
+                         sha1=checksum)
+        if checksum == previous.get('sha1') and \
+                os.path.exists(experiment_file):
+            return (experiment_id, experiment_file, new_state, False)
+
+        write_file_atomic(experiment_file, experiment.content)
+        if verbose:
+            print("Writing XML file to: {0}".format(experiment_file))
+        return (experiment_id, experiment_file, new_state, True)
+
+
+def extract_experiment_xml(config, session, experiment_dir, extract=None,
+                           jobs=default_jobs):
     """
     Open an experiments csv file, then extract the XML representation,
     and write it to disk.
 
+    Experiments are downloaded in parallel; files of experiments that did not
+    change since the last extraction are left alone, and files of experiments
+    that are no longer extracted are removed.
+
     :param config: dict
     :param session: requests.session
     :param experiment_dir: str
     :param extract: int
+    :param jobs: int (number of parallel downloads)
     :return: str
     """
-    entities = get_entities(config)
     experiments_file = write_experiments(config, session)
-    # make sure the output directory exists and is empty
+    # make sure the output directory exists
     outdir = os.path.abspath(experiment_dir)
     if not os.path.exists(outdir):
         os.mkdir(outdir)
-    else:
-        [os.remove(f) for f in glob.glob(os.path.join(outdir, '*'))]
     df_experiments = pd.read_csv(experiments_file)
     if not extract:
         if verbose:
             print("Running XML extraction for all sessions: {0} Total".format(df_experiments.shape[0]))
         extract = df_experiments.shape[0]
-    experiment_ids = df_experiments.ID[:extract]
+    experiment_ids = df_experiments.ID[:extract].tolist()
+
+    # remove files of experiments that are not extracted (anymore)
+    experiment_filenames = set(['{0}.xml'.format(experiment_id)
+                                for experiment_id in experiment_ids])
+    for f in glob.glob(os.path.join(outdir, '*')):
+        if os.path.basename(f) not in experiment_filenames:
+            os.remove(f)
+
+    state = read_download_state(outdir)
+    downloader = ExperimentDownloader(config, session, outdir, state)
+    pool = ThreadPool(max(1, jobs))
+    try:
+        results = pool.map(downloader.download, experiment_ids, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
     experiment_files = list()
-    for idx, experiment_id in experiment_ids.iteritems():
-        experiment = session.get(entities.get('experiment')(experiment_id) + return_format)
-        experiment_file = os.path.join(outdir, '{0}.xml'.format(experiment_id))
-        experiment_files.append(experiment_file)
-        with open(experiment_file, 'w') as fi:
-            fi.flush()
-            fi.write(experiment.text)
-            fi.close()
-        if verbose:
-            num = idx + 1
-            print("Writing XML file {0} of {1} to: {2}".format(num, extract, experiment_file))
+    new_state = dict()
+    written = 0
+    for (experiment_id, experiment_file, experiment_state, was_written) in results:
+        if experiment_file:
+            experiment_files.append(experiment_file)
+            new_state[experiment_id] = experiment_state
+            written += was_written
+    write_file_atomic(os.path.join(outdir, download_state_filename),
+                      json.dumps(new_state, indent=1, sort_keys=True))
+    if verbose:
+        print("Extracted {0} of {1} experiments ({2} new or changed)".format(len(experiment_files), len(experiment_ids), written))
     return experiment_files
 
 
@@ -323,6 +474,160 @@ def get_experiments_dir_scan_info(experiments_dir):
     return results
 
 
+def get_child_text(element, tag):
+    child = element.find(tag)
+    if child is None:
+        return None
+    return child.text
+
+
+def parse_experiment_file(experiment_xml_file):
+    """
+    Extract experiment, scan, and reading information from an XNAT experiment
+    XML document in one streaming pass. The results are the same as those of
+    `get_experiment_info`, `get_scans_info`, and `get_reading_info`.
+
+    :param experiment_xml_file: str
+    :return: tuple (dict, list of dict, dict)
+    """
+    root = None
+    depth = 0
+    experiment_date = None
+    subject_id = None
+    note = None
+    scans = list()
+    # names of the session's custom fields, and the text nodes of all fields
+    # by name (anywhere in the document, as found by the XPath query used
+    # by `get_reading_info`)
+    field_names = list()
+    field_texts = dict()
+    in_fields = False
+
+    for (event, element) in etree.iterparse(experiment_xml_file,
+                                            events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            elif depth == 1 and element.tag == xnat_tags['fields']:
+                in_fields = True
+            depth += 1
+            continue
+
+        depth -= 1
+        tag = element.tag
+        if tag == xnat_tags['field']:
+            texts = field_texts.setdefault(element.attrib.get('name'), list())
+            if element.text:
+                texts.append(element.text)
+            texts += [child.tail for child in element if child.tail]
+            if in_fields and depth == 2:
+                field_names.append(element.attrib.get('name'))
+        elif tag == xnat_tags['scan'] and depth == 2 and \
+                element.getparent().tag == xnat_tags['scans']:
+            scans.append(dict(
+                scan_id=element.attrib.get('ID'),
+                scan_type=element.attrib.get('type'),
+                quality=get_child_text(element, xnat_tags['quality']),
+                series_description=get_child_text(
+                    element, xnat_tags['series_description']),
+                coil=get_child_text(element, xnat_tags['coil']),
+                field_strength=get_child_text(element,
+                                              xnat_tags['fieldStrength'])))
+            element.clear()
+        elif depth == 1:
+            if tag == xnat_tags['date'] and experiment_date is None:
+                experiment_date = element.text
+            elif tag == xnat_tags['subject_ID'] and subject_id is None:
+                subject_id = element.text
+            elif tag == xnat_tags['note'] and note is None:
+                note = element.text
+            elif tag == xnat_tags['fields']:
+                in_fields = False
+            # free the memory of processed top-level elements
+            element.clear()
+            while element.getprevious() is not None:
+                del root[0]
+
+    site_experiment_id = root.attrib.get('label')
+    experiment_id = root.attrib.get('ID')
+    experiment = dict(site_id=site_experiment_id[0:11],
+                      subject_id=subject_id,
+                      site_experiment_id=site_experiment_id,
+                      site_experiment_date=site_experiment_id[12:20],
+                      project=root.attrib.get('project'),
+                      experiment_id=experiment_id,
+                      experiment_date=experiment_date)
+
+    for scan in scans:
+        scan.update(experiment_id=experiment_id)
+
+    reading = dict([(column, None) for column in reading_columns])
+    reading.update(experiment_id=experiment_id, note=note)
+    for name in field_names:
+        texts = field_texts.get('{0}'.format(name), list())
+        if len(texts) > 1:
+            reading[name] = texts[1]
+        else:
+            reading[name] = None
+
+    if verbose:
+        print("Parsed experiment info for: {0}".format(experiment))
+    return (experiment, scans, reading)
+
+
+def records_to_columns(records):
+    """
+    Convert a list of dicts to a dict of columns; values missing from a
+    record are NaN, as in a pandas.DataFrame made from the list
+
+    :param records: list of dict
+    :return: dict of str -> list
+    """
+    names = set()
+    for record in records:
+        names.update(record.keys())
+    missing = float('nan')
+    return dict([(name, [record.get(name, missing) for record in records])
+                 for name in names])
+
+
+def get_experiments_dir_all_info(experiments_dir, jobs=default_parse_jobs):
+    """
+    Get experiment, scan, and reading data frames from all the experiment xml
+    files in the experiments directory, parsing each file only once. Files are
+    parsed in parallel by a pool of processes.
+
+    :param experiments_dir: str
+    :param jobs: int (number of parsing processes)
+    :return: tuple of pandas.DataFrame (experiments, scans, reading)
+    """
+    if os.path.exists(os.path.abspath(experiments_dir)):
+        glob_path = ''.join([os.path.abspath(experiments_dir), '/*'])
+        experiment_files = glob.glob(glob_path)
+    else:
+        experiment_files = list()
+
+    jobs = min(jobs, len(experiment_files))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(parse_experiment_file, experiment_files,
+                               chunksize=max(1, len(experiment_files) /
+                                             (4 * jobs)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [parse_experiment_file(path) for path in experiment_files]
+
+    experiments = [result[0] for result in results]
+    scans = [scan for result in results for scan in result[1]]
+    reading = [result[2] for result in results]
+    return (pd.DataFrame(records_to_columns(experiments)),
+            pd.DataFrame(records_to_columns(scans)),
+            pd.DataFrame(records_to_columns(reading)))
+
+
 def get_scans_by_type(scans, scan_type):
     """
     Get scans based on their type
@@ -345,6 +650,8 @@ def scans_to_dataframe(scans):
     :param scans: dict
     :return: pandas.DataFrame
     """
+    if isinstance(scans, pd.DataFrame):
+        return scans
     flat = [item for sublist in scans for item in sublist]
     return pd.DataFrame(flat)
 
@@ -356,6 +663,8 @@ def experiments_to_dataframe(experiments):
     :param experiments: dict
     :return: pandas.DataFrame
     """
+    if isinstance(experiments, pd.DataFrame):
+        return experiments
     return pd.DataFrame(experiments)
 
 
@@ -366,6 +675,8 @@ def reading_to_dataframe(reading):
     :param reading: dict
     :return: pandas.DataFrame
     """
+    if isinstance(reading, pd.DataFrame):
+        return reading
     return pd.DataFrame(reading)
 
 
@@ -373,8 +684,9 @@ def merge_experiments_scans_reading(experiments, scans, reading):
     """
     Merge an experiments dataframe with a scan dataframe
 
-    :param experiments: dict
-    :param scans: dict
+    :param experiments: dict (or pandas.DataFrame)
+    :param scans: dict (or pandas.DataFrame)
+    :param reading: dict (or pandas.DataFrame)
     :return: pandas.DataFrame
     """
     experiments_df = experiments_to_dataframe(experiments)
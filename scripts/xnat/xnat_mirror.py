@@ -0,0 +1,649 @@
+#!/usr/bin/env python
+
+##
+##  Copyright 2016 SRI International
+##  See COPYING file distributed along with the package for the copyright and license terms.
+##
+"""
+====================
+XNAT Metadata Mirror
+====================
+
+Local SQLite copy of the XNAT metadata that the REDCap and XNAT check scripts
+read: subjects, MR sessions, their scans, resources, files, and custom
+variables.
+
+Most of these scripts used to query XNAT for the full subject and session
+lists, and then walk experiments one by one. The mirror keeps all of this in a
+database file shared by all scripts, and refreshes it incrementally. All
+sessions are listed with one search, and like check_new_sessions, the mirror
+relies on xnat:mrSessionData/LAST_MODIFIED (and INSERT_DATE): only the
+sessions that are new, or whose dates differ from those in the mirror, are
+downloaded again. Sessions deleted from XNAT are dropped from the mirror.
+
+Editing a scan or adding resources and files does not necessarily update a
+session's modification date. The scans of all sessions (ID, type, and
+quality) and their resources (label and file count) are therefore also listed,
+with one search each, and sessions whose scans or resources differ from the
+mirror are downloaded again as well.
+
+Scripts open the mirror with `open_mirror`, which does not refresh it again
+if it was refreshed within the last few minutes, e.g., by a previous script of
+the same cron job. A full refresh, which downloads all sessions, is only
+needed as an occasional consistency check (e.g., weekly), for changes that
+none of these listings show.
+
+The mirror can be refreshed from the command line, e.g.:
+
+python xnat_mirror.py -v
+
+or completely, by downloading all sessions:
+
+python xnat_mirror.py --full
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import xml.etree.ElementTree as ElementTree
+
+import pyxnat
+
+# Default location of the mirror database
+default_mirror_file = os.path.join(os.path.expanduser("~"), '.cache', 'xnat',
+                                   'xnat_mirror.sqlite')
+
+# Date format for XNAT dates
+xnat_date_format = '%Y-%m-%d %H:%M:%S'
+
+# Namespace of XNAT's XML representation of experiments
+ns = {'xnat': 'http://nrg.wustl.edu/xnat'}
+
+# Fields of MR sessions read from XNAT, in the order of the `experiments`
+# table columns that they fill
+session_fields = ['xnat:mrSessionData/SESSION_ID',
+                  'xnat:mrSessionData/SUBJECT_ID',
+                  'xnat:mrSessionData/PROJECT',
+                  'xnat:mrSessionData/PROJECTS',
+                  'xnat:mrSessionData/LABEL',
+                  'xnat:mrSessionData/DATE',
+                  'xnat:mrSessionData/TIME',
+                  'xnat:mrSessionData/SCANNER',
+                  'xnat:mrSessionData/INSERT_DATE',
+                  'xnat:mrSessionData/LAST_MODIFIED']
+
+session_columns = ['experiment_id', 'subject_id', 'project', 'projects',
+                   'label', 'date', 'time', 'scanner', 'insert_date',
+                   'last_modified']
+
+# Fields of MR scans read from XNAT to detect sessions with changed scans
+scan_fields = ['xnat:mrScanData/IMAGE_SESSION_ID',
+               'xnat:mrScanData/ID',
+               'xnat:mrScanData/TYPE',
+               'xnat:mrScanData/QUALITY']
+
+# Columns of the experiment listing read from XNAT to detect sessions with
+# changed resources
+resource_label_column = 'xnat:mrSessionData/resources/resource/label'
+resource_file_count_column = 'xnat:mrSessionData/resources/resource/file_count'
+
+# Age (in seconds) up to which open_mirror does not refresh the mirror again
+default_max_age = 900
+
+schema = """
+CREATE TABLE IF NOT EXISTS properties (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS subjects (
+    subject_id TEXT,
+    label TEXT,
+    project TEXT
+);
+CREATE INDEX IF NOT EXISTS subjects_label ON subjects (label);
+CREATE TABLE IF NOT EXISTS experiments (
+    experiment_id TEXT PRIMARY KEY,
+    subject_id TEXT,
+    project TEXT,
+    projects TEXT,
+    label TEXT,
+    date TEXT,
+    time TEXT,
+    scanner TEXT,
+    insert_date TEXT,
+    last_modified TEXT,
+    manufacturer TEXT,
+    note TEXT
+);
+CREATE INDEX IF NOT EXISTS experiments_subject ON experiments (subject_id, date);
+CREATE TABLE IF NOT EXISTS scans (
+    experiment_id TEXT,
+    scan_id TEXT,
+    position INTEGER,
+    type TEXT,
+    quality TEXT,
+    frames TEXT,
+    series_description TEXT,
+    PRIMARY KEY (experiment_id, scan_id)
+);
+CREATE TABLE IF NOT EXISTS fields (
+    experiment_id TEXT,
+    name TEXT,
+    value TEXT,
+    PRIMARY KEY (experiment_id, name)
+);
+CREATE TABLE IF NOT EXISTS resources (
+    experiment_id TEXT,
+    resource_id TEXT,
+    label TEXT,
+    PRIMARY KEY (experiment_id, resource_id)
+);
+CREATE TABLE IF NOT EXISTS files (
+    experiment_id TEXT,
+    resource_id TEXT,
+    name TEXT,
+    size TEXT,
+    uri TEXT
+);
+CREATE INDEX IF NOT EXISTS files_resource ON files (experiment_id, resource_id);
+CREATE TABLE IF NOT EXISTS pending (
+    experiment_id TEXT PRIMARY KEY
+);
+"""
+
+# Tables with per-experiment details
+detail_tables = ['scans', 'fields', 'resources', 'files']
+
+
+def get_element_text(element, path):
+    """
+    Get the stripped text of an XML element, or None if there is no such
+    element
+
+    :param element: `ElementTree.Element`
+    :param path: str
+    :return: str
+    """
+    child = element.find(path, ns)
+    if child is None:
+        return None
+    return (child.text or '').strip()
+
+
+def parse_experiment_xml(xml):
+    """
+    Get note, scanner manufacturer, custom variables, and scans from the XML
+    representation of an MR session
+
+    Raises ValueError if the XML is not an MR session (e.g., an error page),
+    so that a session is never stored with an empty note and custom variables
+    just because they could not be read.
+
+    :param xml: str
+    :return: dict
+    """
+    root = ElementTree.fromstring(xml)
+    if root.tag != '{%s}MRSession' % ns['xnat']:
+        raise ValueError("Not an MR session document (root element %s)" %
+                         root.tag)
+
+    scanner = root.find('xnat:scanner', ns)
+    manufacturer = None
+    if scanner is not None:
+        manufacturer = scanner.get('manufacturer')
+
+    # XML comments are dropped by the parser, as they were by the regular
+    # expressions that scripts used to read custom variables
+    fields = [(field.get('name'), (field.text or '').strip())
+              for field in root.findall('xnat:fields/xnat:field', ns)]
+
+    scans = []
+    for (position, scan) in enumerate(root.findall('xnat:scans/xnat:scan',
+                                                   ns)):
+        scans.append((scan.get('ID'), position, scan.get('type'),
+                      get_element_text(scan, 'xnat:quality'),
+                      get_element_text(scan, 'xnat:frames'),
+                      get_element_text(scan, 'xnat:series_description')))
+
+    return dict(note=get_element_text(root, 'xnat:note') or '',
+                manufacturer=manufacturer, fields=fields, scans=scans)
+
+
+class XnatMirror(object):
+    """
+    SQLite mirror of the metadata of one XNAT server
+    """
+    def __init__(self, xnat, mirror_file=default_mirror_file, verbose=False):
+        self.xnat = xnat
+        self.mirror_file = mirror_file
+        self.verbose = verbose
+
+        dirname = os.path.dirname(os.path.abspath(mirror_file))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(mirror_file, timeout=300)
+        self.db.text_factory = str
+        self.db.executescript(schema)
+
+    def _get_property(self, name, default=None):
+        row = self.db.execute('SELECT value FROM properties WHERE name=?',
+                              (name,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def _set_property(self, name, value):
+        self.db.execute('INSERT OR REPLACE INTO properties VALUES (?,?)',
+                        (name, value))
+
+    def _refresh_subjects(self):
+        subjects = self.xnat.select('xnat:subjectData',
+                                    ['xnat:subjectData/SUBJECT_ID',
+                                     'xnat:subjectData/SUBJECT_LABEL',
+                                     'xnat:subjectData/PROJECT']).where(
+            [('xnat:subjectData/SUBJECT_LABEL', 'LIKE', '%')]).items()
+        with self.db:
+            self.db.execute('DELETE FROM subjects')
+            self.db.executemany('INSERT INTO subjects VALUES (?,?,?)',
+                                subjects)
+        return len(subjects)
+
+    def _refresh_session_list(self, full=False):
+        """
+        Update the session list, and mark the sessions that are new, or whose
+        LAST_MODIFIED or INSERT_DATE differs from the mirror, for download of
+        their details
+
+        :param full: bool (mark all sessions for download)
+        :return: int (number of changed sessions)
+        """
+        xnat_sessions = self.xnat.select('xnat:mrSessionData',
+                                         session_fields).where(
+            [('xnat:mrSessionData/SESSION_ID', 'LIKE', '%')]).items()
+
+        mirror_dates = dict([(eid, (insert_date or '', last_modified or ''))
+                             for (eid, insert_date, last_modified) in
+                             self.db.execute('SELECT experiment_id, '
+                                             'insert_date, last_modified '
+                                             'FROM experiments')])
+        changed_ids = [session[0] for session in xnat_sessions
+                       if full or mirror_dates.get(session[0]) !=
+                       (session[8] or '', session[9] or '')]
+        deleted_ids = set(mirror_dates.keys()) - \
+            set([session[0] for session in xnat_sessions])
+
+        with self.db:
+            for session in xnat_sessions:
+                self.db.execute(
+                    'INSERT OR IGNORE INTO experiments (experiment_id) '
+                    'VALUES (?)', (session[0],))
+                self.db.execute(
+                    'UPDATE experiments SET %s WHERE experiment_id=?' %
+                    ','.join(['%s=?' % c for c in session_columns[1:]]),
+                    tuple(session[1:]) + (session[0],))
+            self.db.executemany('INSERT OR IGNORE INTO pending VALUES (?)',
+                                [(eid,) for eid in changed_ids])
+
+            for eid in deleted_ids:
+                for table in ['experiments', 'pending'] + detail_tables:
+                    self.db.execute('DELETE FROM %s WHERE experiment_id=?' %
+                                    table, (eid,))
+
+        if self.verbose and deleted_ids:
+            print "Dropped %d sessions deleted from XNAT" % len(deleted_ids)
+        return len(changed_ids)
+
+    def _find_changed_scans(self):
+        """
+        Mark the sessions whose scans (IDs, types, or quality) in XNAT differ
+        from the mirror for download of their details
+
+        :return: int (number of sessions with changed scans)
+        """
+        xnat_scans = dict()
+        for (eid, scan_id, scan_type, quality) in self.xnat.select(
+                'xnat:mrScanData', scan_fields).where(
+                [('xnat:mrScanData/IMAGE_SESSION_ID', 'LIKE', '%')]).items():
+            xnat_scans.setdefault(eid, set()).add(
+                (scan_id, scan_type or '', quality or ''))
+
+        mirror_scans = dict()
+        for (eid, scan_id, scan_type, quality) in self.db.execute(
+                'SELECT experiment_id, scan_id, type, quality FROM scans'):
+            mirror_scans.setdefault(eid, set()).add(
+                (scan_id, scan_type or '', quality or ''))
+
+        known_ids = set([eid for (eid,) in self.db.execute(
+            'SELECT experiment_id FROM experiments')])
+        changed_ids = [eid for eid in sorted(known_ids)
+                       if xnat_scans.get(eid, set()) !=
+                       mirror_scans.get(eid, set())]
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO pending VALUES (?)',
+                                [(eid,) for eid in changed_ids])
+        return len(changed_ids)
+
+    def _find_changed_resources(self):
+        """
+        Mark the sessions whose resources (labels, and numbers of files where
+        XNAT lists them) in XNAT differ from the mirror for download of their
+        details
+
+        :return: int (number of sessions with changed resources)
+        """
+        listing = self.xnat._get_json(
+            '/data/experiments?xsiType=xnat:mrSessionData&columns=ID,%s,%s'
+            '&format=json' % (resource_label_column,
+                              resource_file_count_column))
+
+        # Columns selected by their XML path may come back in lower case
+        xnat_resources = dict()
+        for row in listing:
+            row = dict([(key.lower(), value) for (key, value) in row.items()])
+            if resource_label_column.lower() not in row:
+                raise ValueError("Experiment listing has no column %s" %
+                                 resource_label_column)
+            (labels, file_count) = xnat_resources.setdefault(
+                row['id'], ([], 0))
+            label = row[resource_label_column.lower()] or ''
+            count = row.get(resource_file_count_column.lower()) or ''
+            if not label and not count:
+                # Session without resources
+                continue
+            labels.append(label)
+            if file_count is not None and count.isdigit():
+                file_count += int(count)
+            else:
+                # Compare only labels if XNAT does not know all file counts
+                file_count = None
+            xnat_resources[row['id']] = (labels, file_count)
+
+        mirror_resources = dict()
+        for (eid, label, count) in self.db.execute(
+                'SELECT r.experiment_id, r.label, COUNT(f.name) '
+                'FROM resources r LEFT JOIN files f '
+                'ON f.experiment_id=r.experiment_id '
+                'AND f.resource_id=r.resource_id '
+                'GROUP BY r.experiment_id, r.resource_id'):
+            (labels, file_count) = mirror_resources.get(eid, ([], 0))
+            mirror_resources[eid] = (labels + [label or ''], file_count + count)
+
+        known_ids = set([eid for (eid,) in self.db.execute(
+            'SELECT experiment_id FROM experiments')])
+        changed_ids = []
+        for eid in sorted(known_ids):
+            (xnat_labels, xnat_count) = xnat_resources.get(eid, ([], 0))
+            (mirror_labels, mirror_count) = mirror_resources.get(eid, ([], 0))
+            if sorted(xnat_labels) != sorted(mirror_labels) or \
+                    xnat_count not in (None, mirror_count):
+                changed_ids.append(eid)
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO pending VALUES (?)',
+                                [(eid,) for eid in changed_ids])
+        return len(changed_ids)
+
+    def _refresh_experiment(self, eid):
+        details = parse_experiment_xml(self.xnat.select.experiment(eid).get())
+
+        resources = []
+        files = []
+        for resource in self.xnat._get_json(
+                '/data/experiments/%s/resources/?format=json' % eid):
+            resource_id = resource['xnat_abstractresource_id']
+            resources.append((eid, resource_id, resource['label']))
+            for fl in self.xnat._get_json(
+                    '/data/experiments/%s/resources/%s/files?format=json' %
+                    (eid, resource_id)):
+                files.append((eid, resource_id, fl['Name'], fl.get('Size'),
+                              fl.get('URI')))
+
+        with self.db:
+            for table in detail_tables:
+                self.db.execute('DELETE FROM %s WHERE experiment_id=?' %
+                                table, (eid,))
+            self.db.execute('UPDATE experiments SET manufacturer=?, note=? '
+                            'WHERE experiment_id=?',
+                            (details['manufacturer'], details['note'], eid))
+            self.db.executemany('INSERT OR REPLACE INTO scans VALUES '
+                                '(?,?,?,?,?,?,?)',
+                                [(eid,) + scan for scan in details['scans']])
+            self.db.executemany('INSERT OR REPLACE INTO fields VALUES (?,?,?)',
+                                [(eid, name.lower(), value)
+                                 for (name, value) in details['fields']])
+            self.db.executemany('INSERT OR REPLACE INTO resources VALUES '
+                                '(?,?,?)', resources)
+            self.db.executemany('INSERT INTO files VALUES (?,?,?,?,?)', files)
+            self.db.execute('DELETE FROM pending WHERE experiment_id=?',
+                            (eid,))
+
+    def refresh(self, full=False):
+        """
+        Bring the mirror up to date with XNAT
+
+        :param full: bool (download all sessions, not only changed ones)
+        :return: None
+        """
+        start = time.time()
+        now_str = time.strftime(xnat_date_format)
+
+        subject_count = self._refresh_subjects()
+        changed_count = self._refresh_session_list(full=full)
+        changed_scans_count = 0
+        changed_resources_count = 0
+        if not full:
+            try:
+                changed_scans_count = self._find_changed_scans()
+            except Exception, e:
+                print "WARNING: could not list scans in XNAT to find " \
+                      "changed scans: %s" % e
+            try:
+                changed_resources_count = self._find_changed_resources()
+            except Exception, e:
+                print "WARNING: could not list resources in XNAT to find " \
+                      "changed resources: %s" % e
+
+        pending = [eid for (eid,) in self.db.execute(
+            'SELECT experiment_id FROM pending ORDER BY experiment_id')]
+        failed = 0
+        for eid in pending:
+            try:
+                self._refresh_experiment(eid)
+            except Exception, e:
+                # The session stays pending and is tried again next time
+                print "WARNING: could not read session %s from XNAT: %s" % \
+                    (eid, e)
+                failed += 1
+
+        with self.db:
+            self._set_property('last_refresh', now_str)
+            if full:
+                self._set_property('last_full_refresh', now_str)
+
+        if self.verbose:
+            print "XNAT mirror %s: %d subjects, %d sessions new or modified, " \
+                  "%d sessions with changed scans, %d sessions with changed " \
+                  "resources, %d sessions downloaded (%d failed) in %.1fs" % (
+                      self.mirror_file, subject_count, changed_count,
+                      changed_scans_count, changed_resources_count,
+                      len(pending) - failed, failed, time.time() - start)
+
+    def get_age(self):
+        """
+        Get the time since the last refresh of the mirror
+
+        :return: float (seconds), or None if the mirror was never refreshed
+        """
+        last_refresh = self._get_property('last_refresh')
+        if last_refresh is None:
+            return None
+        return time.time() - time.mktime(time.strptime(last_refresh,
+                                                       xnat_date_format))
+
+    #
+    # Queries
+    #
+    def get_subjects(self, label_pattern='%'):
+        """
+        Get subjects by label
+
+        :param label_pattern: str (SQL LIKE pattern, as in XNAT searches)
+        :return: list of (label, subject_id, project)
+        """
+        return self.db.execute('SELECT label, subject_id, project '
+                               'FROM subjects WHERE label LIKE ? '
+                               'ORDER BY rowid', (label_pattern,)).fetchall()
+
+    def get_sessions(self, columns, label_pattern='%', subject_id=None):
+        """
+        Get MR sessions by label and, optionally, subject
+
+        :param columns: list of str (columns of the `experiments` table)
+        :param label_pattern: str (SQL LIKE pattern, as in XNAT searches)
+        :param subject_id: str
+        :return: list of tuples
+        """
+        for column in columns:
+            if column not in session_columns + ['manufacturer', 'note']:
+                raise ValueError("Unknown session column %s" % column)
+        query = 'SELECT %s FROM experiments WHERE label LIKE ?' % \
+            ','.join(columns)
+        parameters = (label_pattern,)
+        if subject_id is not None:
+            query += ' AND subject_id=?'
+            parameters += (subject_id,)
+        return self.db.execute(query + ' ORDER BY experiment_id',
+                               parameters).fetchall()
+
+    def has_session(self, eid):
+        """
+        Check whether a session and all its details are in the mirror
+
+        :param eid: str
+        :return: bool
+        """
+        return self.db.execute(
+            'SELECT 1 FROM experiments WHERE experiment_id=? AND '
+            'experiment_id NOT IN (SELECT experiment_id FROM pending)',
+            (eid,)).fetchone() is not None
+
+    def get_session(self, eid):
+        """
+        Get all columns of one session
+
+        :param eid: str
+        :return: dict, or None if the session is not in the mirror
+        """
+        cursor = self.db.execute('SELECT * FROM experiments '
+                                 'WHERE experiment_id=?', (eid,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def get_scans(self, eid):
+        """
+        Get the scans of a session, in the order XNAT lists them
+
+        :param eid: str
+        :return: list of (scan_id, type, quality), with '' for a missing type
+                 or quality, as in XNAT
+        """
+        return self.db.execute("SELECT scan_id, IFNULL(type, ''), "
+                               "IFNULL(quality, '') FROM scans "
+                               'WHERE experiment_id=? ORDER BY position',
+                               (eid,)).fetchall()
+
+    def get_custom_variables(self, eid, field_names, default_value=None):
+        """
+        Get custom variables of a session
+
+        :param eid: str
+        :param field_names: list of str
+        :param default_value: value of variables that are not set
+        :return: list
+        """
+        values = dict(self.db.execute('SELECT name, value FROM fields '
+                                      'WHERE experiment_id=?', (eid,)))
+        return [values.get(name.lower(), default_value)
+                for name in field_names]
+
+    def get_resources(self, eid):
+        """
+        Get the resources of a session
+
+        :param eid: str
+        :return: list of (resource_id, label)
+        """
+        return self.db.execute('SELECT resource_id, label FROM resources '
+                               'WHERE experiment_id=? ORDER BY rowid',
+                               (eid,)).fetchall()
+
+    def get_files(self, eid, resource_id):
+        """
+        Get the names of the files in a resource
+
+        :param eid: str
+        :param resource_id: str
+        :return: list of str
+        """
+        return [name for (name,) in self.db.execute(
+            'SELECT name FROM files WHERE experiment_id=? AND resource_id=? '
+            'ORDER BY rowid', (eid, resource_id))]
+
+
+def open_mirror(xnat, mirror_file=default_mirror_file, refresh=True,
+                max_age=default_max_age, verbose=False):
+    """
+    Open the mirror of an XNAT server, bringing it up to date first unless it
+    was refreshed recently
+
+    :param xnat: `pyxnat.Interface`
+    :param mirror_file: str
+    :param refresh: bool
+    :param max_age: int (seconds since the last refresh up to which the
+                    mirror is not refreshed again)
+    :param verbose: bool
+    :return: `XnatMirror`
+    """
+    mirror = XnatMirror(xnat, mirror_file=mirror_file, verbose=verbose)
+    if refresh:
+        age = mirror.get_age()
+        if age is None or not (0 <= age <= max_age):
+            mirror.refresh()
+        elif verbose:
+            print "XNAT mirror %s was refreshed %ds ago" % (mirror_file, age)
+    return mirror
+
+
+def main(args=None):
+    xnat = pyxnat.Interface(config=args.config)
+    mirror = XnatMirror(xnat, mirror_file=args.mirror_file,
+                        verbose=args.verbose)
+    try:
+        mirror.refresh(full=args.full)
+    except Exception, e:
+        print "ERROR: could not refresh XNAT mirror:", e
+        return 1
+
+if __name__ == "__main__":
+    import argparse
+
+    formatter = argparse.RawDescriptionHelpFormatter
+    default = 'default: %(default)s'
+    parser = argparse.ArgumentParser(prog="xnat_mirror.py",
+                                     description=__doc__,
+                                     formatter_class=formatter)
+    parser.add_argument("-f", "--full", dest="full", action="store_true",
+                        help="Download all sessions, not only changed ones")
+    parser.add_argument("--mirror-file", dest="mirror_file",
+                        default=default_mirror_file,
+                        help="Mirror database file. {0}".format(default))
+    parser.add_argument("--config", dest="config",
+                        default=os.path.join(os.path.expanduser("~"),
+                                             '.server_config/ncanda.cfg'),
+                        help="XNAT configuration file. {0}".format(default))
+    parser.add_argument("-v", "--verbose", dest="verbose",
+                        action="store_true", help="Verbose operation")
+    args = parser.parse_args()
+    sys.exit(main(args=args))